@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+# Online backups of mybook.db and static/books, and point-in-time restore.
+# The database is copied with SQLite's backup API a few hundred pages per
+# step. In WAL mode the copying connection pins one read snapshot for the
+# whole copy, so the copy is consistent and writers are never blocked. In
+# rollback-journal mode a step restarts whenever a writer commits, so after
+# a few restarts the rest is copied in one step. Book blobs go into a
+# content-addressed store shared by all backups, so a backup only copies
+# blobs that no earlier backup has. Each backup directory holds the database
+# copy and a manifest naming the blobs it needs. Create, prune and restore
+# hold an exclusive lock on <backup_dir>/.lock, so a prune never deletes the
+# blobs or .partial directory of a backup another process is still writing.
+# Usage: python backup.py create | list | prune | restore <backup>
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: no other process is expected to share the directory
+    fcntl = None
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DB_FILE = os.path.join(BASE_DIR, "mybook.db")
+BOOKS_DIR = os.path.join(BASE_DIR, "static", "books")
+BACKUP_DIR = os.environ.get("BACKUP_DIR", os.path.join(BASE_DIR, "backups"))
+BACKUP_KEEP = int(os.environ.get("BACKUP_KEEP", 7))
+
+BACKUP_PAGES = 256          # pages copied per step
+BACKUP_STEP_PAUSE = 0.002   # seconds between steps, so other connections get the lock
+BACKUP_MAX_RESTARTS = 3     # rollback-journal mode only; then the rest is copied in one step
+
+MANIFEST = "manifest.json"
+DB_COPY = "mybook.db"
+BLOB_STORE = "blobs"
+HASH_CACHE = "hash-cache.json"
+LOCK_FILE = ".lock"
+
+
+class TooManyRestarts(Exception):
+    pass
+
+
+@contextlib.contextmanager
+def backup_lock(backup_dir):
+    """Holds the backup directory's lock; waits while another process has it."""
+    os.makedirs(backup_dir, exist_ok=True)
+    with open(os.path.join(backup_dir, LOCK_FILE), 'a') as f:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def backup_database(src_path, dest_path, pages=BACKUP_PAGES, pause=BACKUP_STEP_PAUSE):
+    """Copies a live database to dest_path. Returns stats about the copy."""
+    src = sqlite3.connect(src_path, timeout=30)
+    dest = sqlite3.connect(dest_path)
+    stats = {"steps": 0, "restarts": 0, "fallback": False}
+    started = time.perf_counter()
+    try:
+        src.isolation_level = None
+        stats["journal_mode"] = src.execute("PRAGMA journal_mode").fetchone()[0]
+        wal = stats["journal_mode"] == "wal"
+        if wal:
+            # Pin a snapshot: later commits go to the WAL and don't restart the copy
+            src.execute("BEGIN")
+            src.execute("SELECT count(*) FROM sqlite_master").fetchone()
+
+        last_remaining = None
+
+        def progress(status, remaining, total):
+            nonlocal last_remaining
+            stats["steps"] += 1
+            if last_remaining is not None and remaining > last_remaining:
+                stats["restarts"] += 1
+                if stats["restarts"] > BACKUP_MAX_RESTARTS:
+                    raise TooManyRestarts()
+            last_remaining = remaining
+            stats["pages"] = total
+            time.sleep(pause)
+
+        try:
+            src.backup(dest, pages=pages, progress=progress)
+        except TooManyRestarts:
+            # Writers keep committing between steps; one step holds them off for the whole copy
+            stats["fallback"] = True
+            src.backup(dest, pages=-1)
+        if wal:
+            src.execute("COMMIT")
+    finally:
+        src.close()
+        dest.close()
+    stats["seconds"] = round(time.perf_counter() - started, 3)
+    return stats
+
+
+def _load_hash_cache(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def copy_blobs(books_dir, backup_dir):
+    """Copies book blobs into the shared store. Returns ({name: sha256}, copied, copied_bytes)."""
+    store = os.path.join(backup_dir, BLOB_STORE)
+    os.makedirs(store, exist_ok=True)
+    cache_path = os.path.join(backup_dir, HASH_CACHE)
+    # name -> [size, mtime_ns, sha256]; unchanged files aren't read again
+    cache = _load_hash_cache(cache_path)
+    blobs = {}
+    copied = copied_bytes = 0
+    for name in sorted(os.listdir(books_dir)):
+        path = os.path.join(books_dir, name)
+        if name.endswith('.tmp') or not os.path.isfile(path):
+            continue
+        st = os.stat(path)
+        cached = cache.get(name)
+        if cached and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+            digest = cached[2]
+        else:
+            digest = file_sha256(path)
+            cache[name] = [st.st_size, st.st_mtime_ns, digest]
+        blobs[name] = digest
+
+        if not os.path.exists(os.path.join(store, digest)):
+            tmp_path = os.path.join(store, f"{name}.tmp")
+            shutil.copyfile(path, tmp_path)
+            copied_digest = file_sha256(tmp_path)
+            if copied_digest != digest:
+                # Replaced while we read it (e.g. transcoded in place); store what we copied
+                del cache[name]
+                blobs[name] = digest = copied_digest
+            os.replace(tmp_path, os.path.join(store, digest))
+            copied += 1
+            copied_bytes += os.path.getsize(os.path.join(store, digest))
+
+    cache = {name: entry for name, entry in cache.items() if name in blobs}
+    with open(cache_path + ".tmp", 'w', encoding='utf-8') as f:
+        json.dump(cache, f)
+    os.replace(cache_path + ".tmp", cache_path)
+    return blobs, copied, copied_bytes
+
+
+def create_backup(db_path=DB_FILE, books_dir=BOOKS_DIR, backup_dir=BACKUP_DIR, keep=BACKUP_KEEP):
+    """Takes a consistent backup of the database and the book store. Returns its manifest."""
+    with backup_lock(backup_dir):
+        manifest = _create_backup(db_path, books_dir, backup_dir)
+        if keep:
+            _prune_backups(backup_dir, keep)
+    return manifest
+
+
+def _create_backup(db_path, books_dir, backup_dir):
+    name = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+    target = os.path.join(backup_dir, name)
+    suffix = 1
+    while os.path.exists(target):
+        target = os.path.join(backup_dir, f"{name}-{suffix}")
+        suffix += 1
+    # Built under a .partial name, so a crashed backup never looks complete
+    partial = target + ".partial"
+    os.makedirs(partial)
+    try:
+        db_copy = os.path.join(partial, DB_COPY)
+        db_stats = backup_database(db_path, db_copy)
+        conn = sqlite3.connect(db_copy)
+        try:
+            check = conn.execute("PRAGMA quick_check").fetchone()[0]
+            user_version = conn.execute("PRAGMA user_version").fetchone()[0]
+        finally:
+            conn.close()
+        if check != "ok":
+            raise RuntimeError(f"Backup copy failed quick_check: {check}")
+
+        # Blobs after the database: every blob the snapshot refers to was written before it
+        blobs, copied, copied_bytes = copy_blobs(books_dir, backup_dir)
+    except BaseException:
+        shutil.rmtree(partial, ignore_errors=True)
+        raise
+
+    manifest = {
+        "name": os.path.basename(target),
+        "created_at": time.time(),
+        "db": {"file": DB_COPY, "sha256": file_sha256(db_copy), "size": os.path.getsize(db_copy),
+               "user_version": user_version, **db_stats},
+        "blobs": blobs,
+        "blobs_copied": copied,
+        "blobs_copied_bytes": copied_bytes,
+    }
+    with open(os.path.join(partial, MANIFEST), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.rename(partial, target)
+    return manifest
+
+
+def list_backups(backup_dir=BACKUP_DIR):
+    """Returns the manifests of complete backups, oldest first."""
+    manifests = []
+    if not os.path.isdir(backup_dir):
+        return manifests
+    for name in sorted(os.listdir(backup_dir)):
+        path = os.path.join(backup_dir, name, MANIFEST)
+        if os.path.isfile(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                manifests.append(json.load(f))
+    return manifests
+
+
+def prune_backups(backup_dir=BACKUP_DIR, keep=BACKUP_KEEP):
+    """Keeps the newest `keep` backups and drops blobs none of them need."""
+    with backup_lock(backup_dir):
+        _prune_backups(backup_dir, keep)
+
+
+def _prune_backups(backup_dir, keep):
+    manifests = list_backups(backup_dir)
+    for manifest in manifests[:-keep]:
+        shutil.rmtree(os.path.join(backup_dir, manifest["name"]))
+    needed = {digest for manifest in manifests[-keep:] for digest in manifest["blobs"].values()}
+    store = os.path.join(backup_dir, BLOB_STORE)
+    if os.path.isdir(store):
+        # Also half-copied blobs (.tmp) of a killed backup
+        for digest in os.listdir(store):
+            if digest not in needed:
+                os.remove(os.path.join(store, digest))
+    # With the lock held no backup is running, so these are leftovers of
+    # backups whose process was killed halfway
+    for name in os.listdir(backup_dir):
+        path = os.path.join(backup_dir, name)
+        if name.endswith(".partial"):
+            shutil.rmtree(path, ignore_errors=True)
+        elif name.endswith(".tmp") and os.path.isfile(path):
+            os.remove(path)
+
+
+def restore_backup(name, db_path=DB_FILE, books_dir=BOOKS_DIR, backup_dir=BACKUP_DIR):
+    """Puts the database and blobs of backup `name` back. Stop the server first."""
+    source = name if os.path.isdir(name) else os.path.join(backup_dir, name)
+    backup_dir = os.path.dirname(os.path.abspath(source))
+    # A prune meanwhile could delete blobs this backup needs
+    with backup_lock(backup_dir):
+        return _restore_backup(source, db_path, books_dir, backup_dir)
+
+
+def _restore_backup(source, db_path, books_dir, backup_dir):
+    with open(os.path.join(source, MANIFEST), 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+
+    # Verify everything before touching the live files
+    db_copy = os.path.join(source, manifest["db"]["file"])
+    if file_sha256(db_copy) != manifest["db"]["sha256"]:
+        raise RuntimeError(f"{db_copy} does not match its manifest hash")
+    store = os.path.join(backup_dir, BLOB_STORE)
+    for blob_name, digest in manifest["blobs"].items():
+        stored = os.path.join(store, digest)
+        if not os.path.exists(stored) or file_sha256(stored) != digest:
+            raise RuntimeError(f"Blob {blob_name} ({digest}) is missing or damaged in {store}")
+
+    os.makedirs(books_dir, exist_ok=True)
+    restored = 0
+    for blob_name, digest in manifest["blobs"].items():
+        path = os.path.join(books_dir, blob_name)
+        if os.path.exists(path) and file_sha256(path) == digest:
+            continue
+        tmp_path = f"{path}.restore.tmp"
+        shutil.copyfile(os.path.join(store, digest), tmp_path)
+        os.replace(tmp_path, path)
+        restored += 1
+
+    # Through the backup API rather than a file copy, so the live database's
+    # journal/WAL can't be replayed over the restored pages
+    src = sqlite3.connect(db_copy)
+    dest = sqlite3.connect(db_path, timeout=30)
+    try:
+        src.backup(dest)
+    finally:
+        src.close()
+        dest.close()
+    # Blobs uploaded after the backup stay in books_dir; the restored database doesn't reference them
+    return {"name": manifest["name"], "blobs_restored": restored, "blobs": len(manifest["blobs"])}
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "create"
+    if command == "create":
+        manifest = create_backup()
+        db = manifest["db"]
+        print(f"Backup {manifest['name']}: database {db['size'] / 1024 / 1024:.1f} MB in {db['seconds']}s "
+              f"({db['steps']} steps, {db['restarts']} restarts), "
+              f"{len(manifest['blobs'])} blobs ({manifest['blobs_copied']} new, "
+              f"{manifest['blobs_copied_bytes'] / 1024 / 1024:.1f} MB)")
+    elif command == "list":
+        for manifest in list_backups():
+            print(f"{manifest['name']}  {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(manifest['created_at']))}  "
+                  f"db {manifest['db']['size'] / 1024 / 1024:.1f} MB  {len(manifest['blobs'])} blobs")
+    elif command == "prune":
+        prune_backups()
+    elif command == "restore" and len(sys.argv) > 2:
+        result = restore_backup(sys.argv[2])
+        print(f"Restored {result['name']}: database and {result['blobs_restored']} of {result['blobs']} blobs")
+    else:
+        print("Usage: python backup.py create | list | prune | restore <backup>")
+        sys.exit(1)
@@ -0,0 +1,120 @@
+import multiprocessing
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+from backup import backup_database
+
+# Latency of request-shaped database work (open a connection, read a shelf,
+# write a note, commit) while another process backs up a large database.
+# Compares no backup, the default page-stepped backup, a one-step backup,
+# and the page-stepped backup on a rollback-journal database.
+# Usage: python bench_backup.py [size_mb]
+
+CLIENTS = 4
+USERS = 1000
+ROW_BYTES = 1000
+
+def build_db(path, size_mb):
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute('''CREATE TABLE books (id TEXT PRIMARY KEY, user_id TEXT, title TEXT, author TEXT,
+                    filepath TEXT, progress INTEGER DEFAULT 0, added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    conn.execute("CREATE INDEX idx_books_user ON books (user_id, added_at)")
+    conn.execute('''CREATE TABLE notes (id TEXT PRIMARY KEY, user_id TEXT NOT NULL, blob TEXT NOT NULL,
+                    paragraph INTEGER NOT NULL, note TEXT, updated_at REAL, seq INTEGER NOT NULL)''')
+    conn.execute("CREATE INDEX idx_notes_user_seq ON notes (user_id, seq)")
+    conn.executemany("INSERT INTO books (id, user_id, title, author, filepath) VALUES (?, ?, ?, ?, ?)",
+                     ((f"b{u}-{i}", f"u{u}", f"书{i}", "佚名", f"{i}.txt") for u in range(USERS) for i in range(10)))
+    rows = size_mb * 1024 * 1024 // ROW_BYTES
+    filler = "x" * ROW_BYTES
+    conn.executemany("INSERT INTO notes (id, user_id, blob, paragraph, note, updated_at, seq) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     ((f"n{i}", f"u{i % USERS}", "a.txt", i, filler, time.time(), i) for i in range(rows)))
+    conn.commit()
+    conn.close()
+
+def client(path, stop, latencies, seed):
+    rng = random.Random(seed)
+    while not stop.is_set():
+        user = f"u{rng.randrange(USERS)}"
+        start = time.perf_counter()
+        conn = sqlite3.connect(path, timeout=30)
+        conn.execute("SELECT id, title, author, progress FROM books WHERE user_id=? ORDER BY added_at DESC", (user,)).fetchall()
+        conn.execute("INSERT INTO notes (id, user_id, blob, paragraph, note, updated_at, seq) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     (os.urandom(8).hex(), user, "a.txt", 0, "note", time.time(), 0))
+        conn.commit()
+        conn.close()
+        latencies.append(time.perf_counter() - start)
+        time.sleep(0.005)
+
+def run_backup(path, dest, pages, result):
+    try:
+        result.update(backup_database(path, dest, pages=pages))
+    except sqlite3.Error as e:
+        result["error"] = str(e)
+
+def scenario(path, label, pages=None, seconds=None):
+    stop = threading.Event()
+    latencies = []
+    threads = [threading.Thread(target=client, args=(path, stop, latencies, i)) for i in range(CLIENTS)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.5)
+    latencies.clear()
+
+    stats = {}
+    if pages is None:
+        time.sleep(seconds)
+    else:
+        dest = path + ".backup"
+        with multiprocessing.Manager() as manager:
+            result = manager.dict()
+            proc = multiprocessing.Process(target=run_backup, args=(path, dest, pages, result))
+            proc.start()
+            proc.join()
+            stats = dict(result)
+        if os.path.exists(dest):
+            os.remove(dest)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    latencies.sort()
+    n = len(latencies)
+    pct = lambda p: latencies[min(n - 1, int(n * p))] * 1000
+    if "error" in stats:
+        backup = f"backup failed: {stats['error']}"
+    elif stats:
+        backup = (f"backup {stats['seconds']:>6.2f}s  {stats['steps']:>5} steps  {stats['restarts']} restarts"
+                  f"{'  fallback' if stats['fallback'] else ''}")
+    else:
+        backup = ""
+    print(f"{label:<28} {n:>6} requests  p50 {pct(0.5):>6.1f} ms  p99 {pct(0.99):>7.1f} ms  "
+          f"max {latencies[-1] * 1000:>7.1f} ms  {backup}")
+    return stats
+
+if __name__ == "__main__":
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        start = time.perf_counter()
+        build_db(path, size_mb)
+        print(f"Built {os.path.getsize(path) / 1024 / 1024:.0f} MB database in {time.perf_counter() - start:.1f}s, "
+              f"{CLIENTS} clients")
+
+        # Warm the page cache so the first scenario isn't the only one reading from disk
+        backup_database(path, path + ".warm", pages=-1)
+        os.remove(path + ".warm")
+
+        stepped = scenario(path, "WAL, stepped (default)", pages=256)
+        scenario(path, "WAL, no backup", seconds=stepped["seconds"])
+        scenario(path, "WAL, one step", pages=-1)
+
+        conn = sqlite3.connect(path)
+        conn.execute("PRAGMA journal_mode=DELETE")
+        conn.close()
+        scenario(path, "rollback journal, stepped", pages=256)
@@ -0,0 +1,90 @@
+import glob
+import http.client
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+# Throughput of the server at WORKERS=1, 2, 4, ... against keep-alive
+# clients reading a shelf (/api/books), the bulk of page-load traffic.
+# Runs a copy of the app in a temporary directory so mybook.db is untouched.
+# Scaling stops at the number of CPUs, which is printed first.
+# Usage: python bench_prefork.py [seconds] [max_workers]
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+PORT = 18931
+CLIENTS = 8
+
+def copy_app(target):
+    for path in glob.glob(os.path.join(BASE_DIR, "*.py")) + glob.glob(os.path.join(BASE_DIR, "*.html")) + [os.path.join(BASE_DIR, "sw.js")]:
+        shutil.copy(path, target)
+    shutil.copytree(os.path.join(BASE_DIR, "static"), os.path.join(target, "static"))
+
+def wait_ready(deadline=30):
+    end = time.time() + deadline
+    while time.time() < end:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{PORT}/healthz", timeout=1) as res:
+                if json.load(res).get("status") == "ok":
+                    return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("server did not become ready")
+
+def login():
+    req = urllib.request.Request(f"http://127.0.0.1:{PORT}/api/login",
+                                 data=json.dumps({"username": "test_user_1", "password": "123456"}).encode(),
+                                 headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(req) as res:
+        return json.load(res)["token"]
+
+def client(token, seconds, counts):
+    conn = http.client.HTTPConnection("127.0.0.1", PORT)
+    headers = {"Authorization": f"Bearer {token}"}
+    done = 0
+    end = time.time() + seconds
+    while time.time() < end:
+        conn.request("GET", "/api/books", headers=headers)
+        conn.getresponse().read()
+        done += 1
+    counts.put(done)
+
+def run(app_dir, workers, seconds):
+    env = dict(os.environ, PORT=str(PORT), WORKERS=str(workers), BOOK_SUMMARIES="0", SOULMATES="0", JOB_WORKERS="0")
+    server = subprocess.Popen([sys.executable, "run_app.py"], cwd=app_dir, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_ready()
+        token = login()
+        counts = multiprocessing.Queue()
+        clients = [multiprocessing.Process(target=client, args=(token, seconds, counts)) for _ in range(CLIENTS)]
+        for proc in clients:
+            proc.start()
+        total = sum(counts.get() for _ in clients)
+        for proc in clients:
+            proc.join()
+        return total / seconds
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+
+if __name__ == "__main__":
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    max_workers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    print(f"{os.cpu_count()} CPUs, {CLIENTS} keep-alive clients, {seconds:.0f}s per run")
+    with tempfile.TemporaryDirectory() as app_dir:
+        copy_app(app_dir)
+        baseline = None
+        workers = 1
+        while workers <= max_workers:
+            rate = run(app_dir, workers, seconds)
+            baseline = baseline or rate
+            print(f"WORKERS={workers:<3} {rate:>8.0f} req/s  x{rate / baseline:.2f}")
+            workers *= 2
@@ -0,0 +1,49 @@
+import itertools
+import random
+import sys
+import time
+import resource
+
+from taste_match import TasteIndex
+
+# Cost of one soulmate pass (index build + top-k for every user) on a
+# synthetic catalogue with a long-tail popularity curve, extrapolated to
+# the full user count from a sample of users.
+# Usage: python bench_soulmates.py [users] [sampled_users]
+
+BOOKS = 50000
+SHELF_MIN, SHELF_MAX = 3, 30
+TOP_K = 10
+
+def synthetic_rows(users, seed=7):
+    rng = random.Random(seed)
+    # Zipf-like: a few books on many shelves, most books on a handful
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(BOOKS)))
+    for u in range(users):
+        user_id = f"user-{u:08d}"
+        shelf = set(rng.choices(range(BOOKS), cum_weights=cum_weights, k=rng.randint(SHELF_MIN, SHELF_MAX)))
+        for book in sorted(shelf):
+            yield user_id, f"book {book}", rng.randint(0, 100)
+
+if __name__ == "__main__":
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    sampled = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+    rows = list(synthetic_rows(users))
+    start = time.perf_counter()
+    index = TasteIndex(rows)
+    build = time.perf_counter() - start
+    del rows
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    step = max(1, index.user_count // sampled)
+    start = time.perf_counter()
+    count = 0
+    for u in range(0, index.user_count, step):
+        index.neighbours(u, TOP_K)
+        count += 1
+    per_user = (time.perf_counter() - start) / count
+
+    print(f"{index.user_count} users, {len(index.titles)} books, {len(index.cols)} shelf entries")
+    print(f"build {build:.1f}s, peak RSS {peak / 1024 / 1024:.0f} MB (includes the generated rows)")
+    print(f"top-{TOP_K}: {per_user * 1000:.2f} ms/user, full pass ~{per_user * index.user_count / 60:.1f} min")
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+# Encoding detection and clean-up for uploaded TXT books.
+# Chinese e-books arrive as GBK/GB18030, Big5, UTF-16 or UTF-8 (with or
+# without BOM). Everything is transcoded once at ingest so the read path
+# can always open books as plain UTF-8.
+import codecs
+import re
+
+BOMS = [
+    (codecs.BOM_UTF32_LE, 'utf-32-le'),
+    (codecs.BOM_UTF32_BE, 'utf-32-be'),
+    (codecs.BOM_UTF8, 'utf-8'),
+    (codecs.BOM_UTF16_LE, 'utf-16-le'),
+    (codecs.BOM_UTF16_BE, 'utf-16-be'),
+]
+
+SAMPLE_BYTES = 64 * 1024
+
+# High-frequency characters that look the same in simplified and traditional
+# text. Real Chinese decoded with the right codec is full of them; the same
+# bytes decoded with the wrong CJK codec almost never produce them.
+COMMON_CHARS = "的一是不了在人有我他你大上中就也地到出要以子着那得而和自之去家心天下过面"
+
+ZERO_WIDTH_CHARS = ('\u200b', '\u200c', '\u200d', '\u2060', '\ufeff')
+ZERO_WIDTH_RE = re.compile('[%s]' % ''.join(ZERO_WIDTH_CHARS))
+TRAILING_WS_CHARS = (' ', '\t', '\u3000', '\xa0')
+TRAILING_WS_RE = re.compile('[ \t\u3000\xa0]+$', re.M)
+BLANK_RUN_RE = re.compile(r'\n{3,}')
+# Markers of site/uploader advertising. Phrases like 更多精彩 are ordinary
+# prose too, so one phrase never condemns a line. A short line is dropped
+# when it has a URL marker and a phrase marker; within the first and last
+# AD_EDGE_LINES lines (where download sites put their banners) a URL marker
+# or two different phrases are enough. ASCII markers are also matched upper-cased.
+AD_URL_MARKERS = ['http://', 'https://', 'www.', '.com', '.net', '.cn/']
+AD_PHRASE_MARKERS = ['txt下载', 'txt小说下载', '本书由', '更多精彩', '更多好书', '免费下载', '手机阅读',
+                     '书友整理', '整理上传', '小说网', '电子书下载']
+AD_URL_MARKERS += [m.upper() for m in AD_URL_MARKERS if m.upper() != m]
+AD_PHRASE_MARKERS += [m.upper() for m in AD_PHRASE_MARKERS if m.upper() != m]
+AD_MARKERS = AD_URL_MARKERS + AD_PHRASE_MARKERS
+AD_LINE_MAX = 80
+AD_EDGE_LINES = 10
+
+
+def _utf16_by_nuls(sample):
+    # Mostly-ASCII UTF-16 has a NUL in every other byte; such data is also valid UTF-8,
+    # so this has to be checked before trying UTF-8.
+    half = len(sample) // 2
+    if half < 2:
+        return None
+    even_nuls = sample[0::2].count(0)
+    odd_nuls = sample[1::2].count(0)
+    if odd_nuls > half * 0.3 and even_nuls < half * 0.05:
+        return 'utf-16-le'
+    if even_nuls > half * 0.3 and odd_nuls < half * 0.05:
+        return 'utf-16-be'
+    return None
+
+
+def _score(text):
+    replaced = text.count('\ufffd')
+    common = sum(text.count(ch) for ch in COMMON_CHARS)
+    return common - 10 * replaced
+
+
+def detect_encoding(data):
+    """Returns (encoding, bom_length) for raw book bytes."""
+    for bom, encoding in BOMS:
+        if data.startswith(bom):
+            return encoding, len(bom)
+
+    sample = data[:SAMPLE_BYTES]
+    utf16 = _utf16_by_nuls(sample)
+    if utf16:
+        return utf16, 0
+
+    try:
+        data.decode('utf-8')
+        return 'utf-8', 0
+    except UnicodeDecodeError:
+        pass
+
+    # Pick whichever codec reads the sample as real Chinese. GB18030 is a
+    # superset of GBK/GB2312, and BOM-less CJK UTF-16 has no NULs to spot.
+    best, best_score = 'gb18030', None
+    for encoding in ('gb18030', 'big5', 'utf-16-le', 'utf-16-be'):
+        score = _score(sample.decode(encoding, errors='replace'))
+        if best_score is None or score > best_score:
+            best, best_score = encoding, score
+    return best, 0
+
+
+def _edge_bounds(text):
+    # Offsets where the first AD_EDGE_LINES lines end and the last AD_EDGE_LINES begin
+    head_end = 0
+    for _ in range(AD_EDGE_LINES):
+        head_end = text.find('\n', head_end) + 1
+        if head_end == 0:
+            return len(text), 0
+    tail_start = len(text.rstrip('\n'))
+    for _ in range(AD_EDGE_LINES):
+        tail_start = text.rfind('\n', 0, tail_start)
+        if tail_start == -1:
+            return len(text), 0
+    return head_end, tail_start + 1
+
+
+def _strip_ad_lines(text):
+    # Plain substring scans per marker: a regex alternation (or a per-line
+    # regex) is an order of magnitude slower on a multi-MB book.
+    head_end, tail_start = _edge_bounds(text)
+    drop = {}
+    checked = set()
+    for marker in AD_MARKERS:
+        pos = text.find(marker)
+        while pos != -1:
+            start = text.rfind('\n', 0, pos) + 1
+            end = text.find('\n', pos)
+            end = len(text) if end == -1 else end + 1
+            if end - start <= AD_LINE_MAX and start not in checked:
+                checked.add(start)
+                line = text[start:end]
+                url = any(m in line for m in AD_URL_MARKERS)
+                phrases = sum(m in line for m in AD_PHRASE_MARKERS)
+                edge = start < head_end or start >= tail_start
+                if (url and phrases) or (edge and (url or phrases >= 2)):
+                    drop[start] = end
+            pos = text.find(marker, end)
+    if not drop:
+        return text, 0
+
+    parts = []
+    last = 0
+    for start in sorted(drop):
+        parts.append(text[last:start])
+        last = drop[start]
+    parts.append(text[last:])
+    return ''.join(parts), len(drop)
+
+
+def clean_text(text):
+    """Normalizes line endings and whitespace and drops advertising lines.
+
+    Returns (text, removed_lines). Paragraph indentation is kept.
+    """
+    text = text.replace('\r\n', '\n').replace('\r', '\n')
+    # Substring checks are far cheaper than a full regex pass, so only
+    # substitute when there is something to remove.
+    if any(ch in text for ch in ZERO_WIDTH_CHARS):
+        text = ZERO_WIDTH_RE.sub('', text)
+    if any(ch + '\n' in text for ch in TRAILING_WS_CHARS) or text.endswith(TRAILING_WS_CHARS):
+        text = TRAILING_WS_RE.sub('', text)
+    text, removed = _strip_ad_lines(text)
+    if '\n\n\n' in text:
+        text = BLANK_RUN_RE.sub('\n\n', text)
+    return text.strip('\n') + '\n', removed
+
+
+def normalize_book(data, clean=True):
+    """Decodes raw book bytes into normalized UTF-8.
+
+    Returns (utf8_bytes, info) where info records the detected encoding and
+    what the clean-up did.
+    """
+    encoding, bom_length = detect_encoding(data)
+    text = data[bom_length:].decode(encoding, errors='replace')
+    removed = 0
+    if clean:
+        text, removed = clean_text(text)
+    out = text.encode('utf-8')
+    info = {
+        "encoding": encoding,
+        "original_size": len(data),
+        "normalized_size": len(out),
+        "removed_lines": removed,
+        "replaced_chars": text.count('\ufffd'),
+    }
+    return out, info
@@ -0,0 +1,72 @@
+import http.server
+import json
+import os
+import socketserver
+import sys
+import threading
+import time
+
+# A stand-in for the DashScope chat completions endpoint, so chat and book
+# summaries run offline. Point the app at it with
+#   DASHSCOPE_API_URL=http://127.0.0.1:8199/v1/chat/completions
+# Replies are derived from the prompt, so they are deterministic. GET /stats
+# reports how many calls came in and the most that ran at once.
+# Usage: python fake_upstream.py [port] [delay_seconds]
+
+class FakeUpstream(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, delay=0.0):
+        super().__init__(address, FakeUpstreamHandler)
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.stats = {"calls": 0, "active": 0, "max_active": 0}
+
+class FakeUpstreamHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        with self.server.lock:
+            self.send_json(200, dict(self.server.stats))
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+        stats = self.server.stats
+        with self.server.lock:
+            stats["calls"] += 1
+            stats["active"] += 1
+            stats["max_active"] = max(stats["max_active"], stats["active"])
+        try:
+            time.sleep(self.server.delay)
+            prompt = body["messages"][-1]["content"]
+            reply = f"概要：{prompt.splitlines()[0][:40]}"
+            self.send_json(200, {"choices": [{"message": {"role": "assistant", "content": reply}}]})
+        finally:
+            with self.server.lock:
+                stats["active"] -= 1
+
+    def send_json(self, status, data):
+        payload = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+def start_fake_upstream(port=0, delay=0.0):
+    """Serves in a daemon thread; returns (server, chat completions URL)."""
+    server = FakeUpstream(("127.0.0.1", port), delay)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1/chat/completions"
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8199
+    delay = float(sys.argv[2]) if len(sys.argv) > 2 else float(os.environ.get("FAKE_UPSTREAM_DELAY", 0))
+    server = FakeUpstream(("127.0.0.1", port), delay)
+    print(f"Fake upstream on http://127.0.0.1:{port}/v1/chat/completions (delay {delay}s)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
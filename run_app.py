@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import http.server
 import socketserver
+import socket
 import json
 import os
 import mimetypes
@@ -11,7 +12,21 @@ import hashlib
 import uuid
 import base64
 import sys
-import os
+import signal
+import threading
+import time
+import math
+import collections
+import re
+import hmac
+import secrets
+import concurrent.futures
+import multiprocessing
+import datetime
+import zoneinfo
+from book_ingest import normalize_book
+from taste_match import TasteIndex
+from backup import create_backup
 
 # --- Configuration ---
 PORT = int(os.environ.get("PORT", 8000))
@@ -20,6 +35,114 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_FILE = os.path.join(BASE_DIR, "mybook.db")
 BOOKS_DIR = os.path.join(BASE_DIR, "static", "books")
 DASHSCOPE_API_KEY = os.environ.get("DASHSCOPE_API_KEY", "")
+# Upstream chat endpoint; override to point at a local fake upstream when testing
+DASHSCOPE_API_URL = os.environ.get("DASHSCOPE_API_URL", "https://dashscope.aliyuncs.com/compatible-mode/v1/chat/completions")
+
+# --- HTTP Keep-Alive Configuration ---
+# Idle seconds before a persistent connection is dropped, and how many
+# requests one connection may carry before the server asks the client to reconnect.
+KEEPALIVE_TIMEOUT = int(os.environ.get("KEEPALIVE_TIMEOUT", 15))
+KEEPALIVE_MAX_REQUESTS = int(os.environ.get("KEEPALIVE_MAX_REQUESTS", 100))
+
+# --- Prefork Configuration ---
+# WORKERS > 1 forks that many server processes sharing one listening socket.
+# GRACEFUL_TIMEOUT is how long a stopping worker may drain before it is killed.
+WORKERS = int(os.environ.get("WORKERS", 1))
+GRACEFUL_TIMEOUT = int(os.environ.get("GRACEFUL_TIMEOUT", 30))
+
+# --- Chat Admission Control Configuration ---
+# Each user may send CHAT_BURST messages at once, refilled at CHAT_RATE_PER_MIN;
+# buckets are per process, so under prefork a user's burst is per worker.
+# At most UPSTREAM_CONCURRENCY upstream calls run at a time across all
+# processes (summaries included); the rest queue (round-robin across users)
+# for up to CHAT_QUEUE_TIMEOUT seconds.
+CHAT_RATE_PER_MIN = float(os.environ.get("CHAT_RATE_PER_MIN", 10))
+CHAT_BURST = int(os.environ.get("CHAT_BURST", 5))
+UPSTREAM_CONCURRENCY = int(os.environ.get("UPSTREAM_CONCURRENCY", 8))
+CHAT_QUEUE_TIMEOUT = float(os.environ.get("CHAT_QUEUE_TIMEOUT", 20))
+CHAT_QUEUE_MAX_PER_USER = int(os.environ.get("CHAT_QUEUE_MAX_PER_USER", 3))
+# Proxies in front of the server that append to X-Forwarded-For (Railway's
+# edge is one); anonymous callers are rate limited by the address they saw.
+TRUSTED_PROXIES = int(os.environ.get("TRUSTED_PROXIES", 1 if "RAILWAY_ENVIRONMENT" in os.environ else 0))
+
+# --- Session & Password Configuration ---
+# Login issues an HMAC-signed session token. Validated sessions are kept in an
+# in-memory LRU and re-checked against the DB every SESSION_CACHE_TTL seconds
+# (so a logout in one worker reaches the others). Set SESSION_SECRET to keep
+# tokens valid across deployments; otherwise one is generated and stored in the DB.
+SESSION_SECRET = os.environ.get("SESSION_SECRET", "")
+SESSION_TTL = int(os.environ.get("SESSION_TTL", 30 * 24 * 3600))
+SESSION_CACHE_SIZE = int(os.environ.get("SESSION_CACHE_SIZE", 10000))
+SESSION_CACHE_TTL = int(os.environ.get("SESSION_CACHE_TTL", 60))
+# PBKDF2 cost; hashing runs on at most KDF_WORKERS threads with KDF_MAX_PENDING queued
+PASSWORD_ITERATIONS = int(os.environ.get("PASSWORD_ITERATIONS", 200000))
+KDF_WORKERS = int(os.environ.get("KDF_WORKERS", 2))
+KDF_MAX_PENDING = int(os.environ.get("KDF_MAX_PENDING", 32))
+# Pages cached from before session tokens name their user with a user_id
+# parameter. Until LEGACY_USER_ID_UNTIL (YYYY-MM-DD, UTC) a request without
+# an Authorization header may still do so; unset, no request may.
+LEGACY_USER_ID_UNTIL = os.environ.get("LEGACY_USER_ID_UNTIL", "")
+
+# --- Notes Sync Configuration ---
+NOTES_SYNC_MAX_CHANGES = 500   # changes accepted per /api/notes/sync call
+NOTES_SYNC_PAGE = 500          # changes returned per call; the client repeats while has_more
+# Deleted notes are kept this long so other devices learn of the delete;
+# a device whose cursor predates a pruned delete gets a full resync
+NOTES_TOMBSTONE_TTL = int(os.environ.get("NOTES_TOMBSTONE_TTL", 90 * 24 * 3600))
+
+# --- Bootstrap Cache Configuration ---
+# /api/bootstrap payloads are cached per user and dropped on that user's writes.
+# In prefork mode a write only clears the worker that handled it, so the TTL
+# bounds how stale another worker's copy can be.
+BOOTSTRAP_CACHE_SIZE = int(os.environ.get("BOOTSTRAP_CACHE_SIZE", 5000))
+BOOTSTRAP_CACHE_TTL = int(os.environ.get("BOOTSTRAP_CACHE_TTL", 30))
+
+# --- Book Summary Configuration ---
+# Book blobs are summarized (per chapter, then the whole book) by
+# summarize_book jobs, so chat can send a short summary instead of a long raw
+# excerpt. Ingest queues one per new blob; every SUMMARY_INTERVAL a pass
+# queues any blob still missing one. The jobs need job workers to run.
+# Without DASHSCOPE_API_KEY nothing is queued, as every call would fail.
+BOOK_SUMMARIES = os.environ.get("BOOK_SUMMARIES", "1") == "1"
+SUMMARY_INTERVAL = int(os.environ.get("SUMMARY_INTERVAL", 600))  # seconds between passes
+SUMMARY_CHAPTER_CHARS = 4000    # chapter text sent to the model per chapter summary
+SUMMARY_CHUNK_CHARS = 20000     # pseudo-chapter size when no chapter headings are found
+SUMMARY_MAX_CHAPTERS = 200      # adjacent chapters are merged beyond this
+SUMMARY_EXCERPT_CHARS = 1500    # raw excerpt still sent alongside a summary
+
+# --- Background Job Configuration ---
+# Uploads and derived-artifact builds run from a persistent queue in the
+# jobs table. JOB_WORKERS=0 leaves the queue to `python run_app.py jobs`.
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 2))
+JOB_POLL_INTERVAL = 1.0     # seconds an idle worker waits before checking the queue again
+JOB_LEASE = 120             # seconds a claimed job stays locked without a heartbeat
+JOB_MAX_ATTEMPTS = 5
+JOB_RETRY_DELAY = 5         # seconds before the first retry, doubled per attempt
+JOB_RETENTION = 7 * 24 * 3600  # finished jobs are kept this long for /api/jobs/<id>
+JOB_PRIORITY_INGEST = 10    # higher runs first
+JOB_PRIORITY_SUMMARY = 0
+INCOMING_DIR = os.path.join(BASE_DIR, "incoming")  # raw uploads waiting for ingest
+ORIGINALS_DIR = os.path.join(BASE_DIR, "originals")  # uploads as received, named by sha256
+
+# --- Reading Stats Configuration ---
+# Reading days and streaks count in the readers' timezone rather than the
+# server's (UTC on Railway), so an evening in Beijing isn't booked as the
+# next or previous day.
+APP_TIMEZONE = os.environ.get("APP_TIMEZONE", "Asia/Shanghai")
+
+# --- Soulmate Recommendation Configuration ---
+# Top-k similar readers per user, recomputed by a background job and served
+# from the soulmates table with one primary-key lookup. A pass is CPU-bound
+# and holds the GIL, so it always runs in a process of its own: a prefork
+# background slot, or with WORKERS=1 a spawned child of the server.
+SOULMATES = os.environ.get("SOULMATES", "1") == "1"
+SOULMATE_INTERVAL = int(os.environ.get("SOULMATE_INTERVAL", 3600))  # seconds between passes
+SOULMATE_TOP_K = 10
+SOULMATE_BATCH = 1000   # users written per transaction
+
+# --- Backup Configuration ---
+# Online backups of the database and static/books (see backup.py).
+BACKUP_INTERVAL = int(os.environ.get("BACKUP_INTERVAL", 0))  # seconds between backups; 0 = off
 
 # --- Default Books Configuration ---
 # These books will be added to ALL users (new and existing)
@@ -47,17 +170,45 @@ SYSTEM_PROMPT = """你叫“会意”，是用户的知心阅读书友。你的
 # Ensure directories exist
 os.makedirs(BOOKS_DIR, exist_ok=True)
 
-# --- Database Initialization ---
-def init_db():
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    
+# --- Passwords ---
+# Stored as "pbkdf2_sha256$<iterations>$<salt hex>$<hash hex>". Rows created
+# before this format hold a bare sha256 hex digest; they still verify and are
+# upgraded on the next successful login.
+
+def hash_password(password, iterations=None):
+    iterations = iterations or PASSWORD_ITERATIONS
+    salt = secrets.token_bytes(16)
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, iterations)
+    return f"pbkdf2_sha256${iterations}${salt.hex()}${digest.hex()}"
+
+def verify_password(password, stored):
+    if not stored:
+        return False
+    if not stored.startswith("pbkdf2_sha256$"):
+        legacy = hashlib.sha256(password.encode()).hexdigest()
+        return hmac.compare_digest(legacy, stored)
+    _, iterations, salt, expected = stored.split('$')
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), bytes.fromhex(salt), int(iterations))
+    return hmac.compare_digest(digest.hex(), expected)
+
+def password_needs_rehash(stored):
+    return not stored.startswith(f"pbkdf2_sha256${PASSWORD_ITERATIONS}$")
+
+# --- Database Migrations ---
+# Each step runs once, in order, inside its own transaction; PRAGMA
+# user_version records how many have been applied, so a started-up server
+# skips them all with one pragma read. Steps stay idempotent because
+# databases created before versioning start at user_version 0 with the
+# tables already present. Append new steps, never edit applied ones
+# (e.g. a change to DEFAULT_BOOKS gets a new add_default_books step).
+
+def migrate_base_tables(c):
     # 1. Users Table
     c.execute('''CREATE TABLE IF NOT EXISTS users
                  (id TEXT PRIMARY KEY, username TEXT UNIQUE, password TEXT, 
                   avatar TEXT, signature TEXT, current_book_id TEXT)''')
     
-    # Migration: Add current_book_id if missing
+    # Add current_book_id if missing
     try:
         c.execute("ALTER TABLE users ADD COLUMN current_book_id TEXT")
     except sqlite3.OperationalError:
@@ -68,8 +219,8 @@ def init_db():
                  (id TEXT PRIMARY KEY, user_id TEXT, title TEXT, author TEXT, 
                   filepath TEXT, progress INTEGER DEFAULT 0, 
                   added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-                  
-    # Check if we need to seed test users
+
+def seed_test_users(c):
     c.execute("SELECT count(*) FROM users")
     if c.fetchone()[0] == 0:
         print("Seeding test users...")
@@ -80,33 +231,1511 @@ def init_db():
         ]
         for name, pwd, ava, sig in test_users:
             try:
-                pwd_hash = hashlib.sha256(pwd.encode()).hexdigest()
+                pwd_hash = hash_password(pwd)
                 uid = str(uuid.uuid4())
                 c.execute("INSERT INTO users (id, username, password, avatar, signature) VALUES (?, ?, ?, ?, ?)",
                           (uid, name, pwd_hash, ava, sig))
             except sqlite3.IntegrityError:
                 pass
-    
-    # --- Ensure Default Books for ALL Users (Migration) ---
-    c.execute("SELECT id FROM users")
-    all_users = c.fetchall()
-    
-    for (user_id,) in all_users:
-        # For each default book, check if user has it
-        for title, author, filename in DEFAULT_BOOKS:
-            # Check by title/author/filepath intersection to avoid duplicates
-            # Using filename as unique key is safest
-            c.execute("SELECT count(*) FROM books WHERE user_id=? AND filepath=?", (user_id, filename))
-            if c.fetchone()[0] == 0:
-                # print(f"Adding default book '{title}' to user {user_id}") - Commented out to prevent UnicodeEncodeError in logs
-                book_id = str(uuid.uuid4())
-                c.execute("INSERT INTO books (id, user_id, title, author, filepath) VALUES (?, ?, ?, ?, ?)",
-                          (book_id, user_id, title, author, filename))
 
+def add_default_books(c):
+    # Give every existing user each default book they don't have yet (new
+    # users get them in handle_register). One set-based INSERT per book
+    # instead of a query per user x book.
+    for title, author, filename in DEFAULT_BOOKS:
+        c.execute('''INSERT INTO books (id, user_id, title, author, filepath)
+                     SELECT uuid4(), u.id, ?, ?, ? FROM users u
+                     WHERE NOT EXISTS (SELECT 1 FROM books b WHERE b.user_id = u.id AND b.filepath = ?)''',
+                  (title, author, filename, filename))
+
+def add_books_user_index(c):
+    # Every shelf query filters on user_id and sorts by added_at
+    c.execute("CREATE INDEX IF NOT EXISTS idx_books_user ON books (user_id, added_at)")
+
+def migrate_summary_tables(c):
+    # Keyed by content hash so identical blobs share one summary
+    c.execute('''CREATE TABLE IF NOT EXISTS chapter_summaries
+                 (content_hash TEXT, chapter_index INTEGER, title TEXT,
+                  start_offset INTEGER, summary TEXT,
+                  PRIMARY KEY (content_hash, chapter_index))''')
+    c.execute('''CREATE TABLE IF NOT EXISTS book_summaries
+                 (content_hash TEXT PRIMARY KEY, summary TEXT, chapter_count INTEGER,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+
+def migrate_book_blobs_table(c):
+    # What ingest did to each file in static/books
+    c.execute('''CREATE TABLE IF NOT EXISTS book_blobs
+                 (filepath TEXT PRIMARY KEY, encoding TEXT, original_size INTEGER,
+                  normalized_size INTEGER, removed_lines INTEGER,
+                  normalized_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+
+def migrate_session_tables(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS sessions
+                 (id TEXT PRIMARY KEY, user_id TEXT, expires_at REAL,
+                  revoked INTEGER DEFAULT 0)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS app_settings
+                 (key TEXT PRIMARY KEY, value TEXT)''')
+    c.execute("INSERT OR IGNORE INTO app_settings (key, value) VALUES ('session_secret', ?)",
+              (secrets.token_hex(32),))
+
+def migrate_notes_tables(c):
+    # Highlights/notes keyed by book blob and paragraph index (the reader's
+    # non-empty lines). seq is the user's change counter at the note's last
+    # write; deletes are kept as tombstones so they sync too.
+    c.execute('''CREATE TABLE IF NOT EXISTS notes
+                 (id TEXT PRIMARY KEY, user_id TEXT NOT NULL, book_id TEXT,
+                  blob TEXT NOT NULL, paragraph INTEGER NOT NULL,
+                  start_offset INTEGER, end_offset INTEGER, quote TEXT, note TEXT,
+                  color TEXT, deleted INTEGER DEFAULT 0, updated_at REAL,
+                  seq INTEGER NOT NULL)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_notes_user_seq ON notes (user_id, seq)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_notes_user_blob ON notes (user_id, blob, paragraph)")
+    c.execute('''CREATE TABLE IF NOT EXISTS note_seq
+                 (user_id TEXT PRIMARY KEY, seq INTEGER NOT NULL)''')
+
+def migrate_soulmates_table(c):
+    # matches is the JSON list served as-is, so serving needs no joins
+    c.execute('''CREATE TABLE IF NOT EXISTS soulmates
+                 (user_id TEXT PRIMARY KEY, matches TEXT NOT NULL, computed_at REAL)''')
+
+def migrate_jobs_tables(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS jobs
+                 (id TEXT PRIMARY KEY, kind TEXT NOT NULL, user_id TEXT,
+                  payload TEXT, state TEXT, status TEXT NOT NULL DEFAULT 'queued',
+                  priority INTEGER DEFAULT 0, stage TEXT, progress REAL DEFAULT 0,
+                  attempts INTEGER DEFAULT 0, max_attempts INTEGER, run_after REAL,
+                  locked_by TEXT, locked_until REAL, error TEXT, result TEXT,
+                  created_at REAL, updated_at REAL)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_jobs_queue ON jobs (status, priority DESC, created_at)")
+    # Lets ingest find an identical blob that is already stored
+    try:
+        c.execute("ALTER TABLE book_blobs ADD COLUMN content_hash TEXT")
+    except sqlite3.OperationalError:
+        pass
+    c.execute("CREATE INDEX IF NOT EXISTS idx_book_blobs_hash ON book_blobs (content_hash)")
+    c.execute('''CREATE TABLE IF NOT EXISTS book_tocs
+                 (content_hash TEXT PRIMARY KEY, toc TEXT NOT NULL)''')
+
+def migrate_user_stats(c):
+    # Furthest reader page reached in each book
+    try:
+        c.execute("ALTER TABLE books ADD COLUMN pages_read INTEGER DEFAULT 0")
+    except sqlite3.OperationalError:
+        pass
+    c.execute('''CREATE TABLE IF NOT EXISTS reading_days
+                 (user_id TEXT NOT NULL, day TEXT NOT NULL,
+                  PRIMARY KEY (user_id, day)) WITHOUT ROWID''')
+    c.execute('''CREATE TABLE IF NOT EXISTS user_stats
+                 (user_id TEXT PRIMARY KEY, books INTEGER NOT NULL DEFAULT 0,
+                  finished INTEGER NOT NULL DEFAULT 0, reading INTEGER NOT NULL DEFAULT 0,
+                  pages_read INTEGER NOT NULL DEFAULT 0, days_read INTEGER NOT NULL DEFAULT 0,
+                  streak INTEGER NOT NULL DEFAULT 0, first_day TEXT, last_day TEXT)''')
+    # Triggers keep user_stats in step with every write to books and
+    # reading_days, whichever code path makes it (register, ingest, progress,
+    # migrations). compute_user_stats is the full recomputation they must match.
+    c.execute('''CREATE TRIGGER IF NOT EXISTS books_stats_insert AFTER INSERT ON books
+                 BEGIN
+                     INSERT OR IGNORE INTO user_stats (user_id) SELECT NEW.user_id WHERE NEW.user_id IS NOT NULL;
+                     UPDATE user_stats SET books = books + 1,
+                         finished = finished + (IFNULL(NEW.progress, 0) >= 100),
+                         reading = reading + (IFNULL(NEW.progress, 0) BETWEEN 1 AND 99),
+                         pages_read = pages_read + IFNULL(NEW.pages_read, 0)
+                     WHERE user_id = NEW.user_id;
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS books_stats_delete AFTER DELETE ON books
+                 BEGIN
+                     UPDATE user_stats SET books = books - 1,
+                         finished = finished - (IFNULL(OLD.progress, 0) >= 100),
+                         reading = reading - (IFNULL(OLD.progress, 0) BETWEEN 1 AND 99),
+                         pages_read = pages_read - IFNULL(OLD.pages_read, 0)
+                     WHERE user_id = OLD.user_id;
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS books_stats_update AFTER UPDATE OF user_id, progress, pages_read ON books
+                 BEGIN
+                     UPDATE user_stats SET books = books - 1,
+                         finished = finished - (IFNULL(OLD.progress, 0) >= 100),
+                         reading = reading - (IFNULL(OLD.progress, 0) BETWEEN 1 AND 99),
+                         pages_read = pages_read - IFNULL(OLD.pages_read, 0)
+                     WHERE user_id = OLD.user_id;
+                     INSERT OR IGNORE INTO user_stats (user_id) SELECT NEW.user_id WHERE NEW.user_id IS NOT NULL;
+                     UPDATE user_stats SET books = books + 1,
+                         finished = finished + (IFNULL(NEW.progress, 0) >= 100),
+                         reading = reading + (IFNULL(NEW.progress, 0) BETWEEN 1 AND 99),
+                         pages_read = pages_read + IFNULL(NEW.pages_read, 0)
+                     WHERE user_id = NEW.user_id;
+                 END''')
+    # Days arrive in order (today's date on each progress write), so the
+    # streak either grows by one, restarts at 1, or stays put
+    c.execute('''CREATE TRIGGER IF NOT EXISTS reading_days_stats AFTER INSERT ON reading_days
+                 BEGIN
+                     INSERT OR IGNORE INTO user_stats (user_id) VALUES (NEW.user_id);
+                     UPDATE user_stats SET days_read = days_read + 1,
+                         streak = CASE WHEN last_day = date(NEW.day, '-1 day') THEN streak + 1
+                                       WHEN last_day IS NULL OR NEW.day > last_day THEN 1
+                                       ELSE streak END,
+                         first_day = MIN(IFNULL(first_day, NEW.day), NEW.day),
+                         last_day = MAX(IFNULL(last_day, NEW.day), NEW.day)
+                     WHERE user_id = NEW.user_id;
+                 END''')
+    rebuild_user_stats(c)
+
+def add_blob_original_hash(c):
+    # The upload a blob was made from, kept in ORIGINALS_DIR
+    try:
+        c.execute("ALTER TABLE book_blobs ADD COLUMN original_hash TEXT")
+    except sqlite3.OperationalError:
+        pass
+
+def add_note_seq_pruned(c):
+    # Highest seq of a tombstone pruned for the user; older cursors must resync
+    try:
+        c.execute("ALTER TABLE note_seq ADD COLUMN pruned_seq INTEGER NOT NULL DEFAULT 0")
+    except sqlite3.OperationalError:
+        pass
+
+MIGRATIONS = [
+    migrate_base_tables,
+    seed_test_users,
+    add_default_books,
+    add_books_user_index,
+    migrate_summary_tables,
+    migrate_book_blobs_table,
+    migrate_session_tables,
+    migrate_notes_tables,
+    migrate_soulmates_table,
+    migrate_jobs_tables,
+    migrate_user_stats,
+    add_blob_original_hash,
+    add_note_seq_pruned,
+]
+
+def migrate_db():
+    conn = sqlite3.connect(DB_FILE)
+    conn.create_function("uuid4", 0, lambda: str(uuid.uuid4()))
+    try:
+        # WAL lets readers (and online backups) run alongside a writer. The
+        # mode is stored in the file and can't change inside a transaction,
+        # so it is set here rather than in a migration step.
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+        except sqlite3.OperationalError as e:
+            print(f"WAL Error: {e}")
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= len(MIGRATIONS):
+            return
+        # IMMEDIATE takes the write lock, so two processes migrating at once run steps in turn
+        conn.isolation_level = None
+        for step in range(version, len(MIGRATIONS)):
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if conn.execute("PRAGMA user_version").fetchone()[0] > step:
+                    conn.execute("ROLLBACK")
+                    continue
+                MIGRATIONS[step](conn.cursor())
+                conn.execute(f"PRAGMA user_version = {step + 1}")
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            print(f"Applied migration {step + 1}: {MIGRATIONS[step].__name__}")
+    finally:
+        conn.close()
+
+# Set once migrations have run; until then API requests get 503 and /healthz reports "starting"
+db_ready = threading.Event()
+
+# --- Upstream Model ---
+
+def build_qwen_body(prompt, system_instruction):
+    # Use Qwen via DashScope compatible API
+    # Endpoint for Qwen-Turbo (Flash equivalent)
+    # User requested "qwen-flash-character" explicitly for free tier.
+    payload = {
+        "model": "qwen-flash-character", 
+        "messages": [
+            {"role": "system", "content": system_instruction},
+            {"role": "user", "content": prompt}
+        ]
+    }
+    return json.dumps(payload, sort_keys=True).encode('utf-8')
+
+def request_qwen(body):
+    # Raises on HTTP/network errors and on an unexpected response shape
+    headers = {
+        'Content-Type': 'application/json',
+        'Authorization': f'Bearer {DASHSCOPE_API_KEY}'
+    }
+    req = urllib.request.Request(DASHSCOPE_API_URL, data=body, headers=headers)
+    with urllib.request.urlopen(req, timeout=30) as response:
+        result = json.loads(response.read().decode('utf-8'))
+    return result['choices'][0]['message']['content']
+
+# --- Upstream Request Coalescing ---
+
+class SingleFlight:
+    """Runs one call per key at a time; concurrent callers with the same key
+    wait for that call and receive its result (or exception).
+
+    Nothing is cached once the call finishes, so a later identical request
+    goes upstream again. Coalescing is per process (per worker in prefork mode).
+
+    Errors of the types in `own_errors` belong to the leader alone (e.g. its
+    admission was refused); followers then try again, one of them as leader.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, own_errors=()):
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                leader = call is None
+                if leader:
+                    call = {"done": threading.Event(), "result": None, "error": None}
+                    self._calls[key] = call
+            if leader:
+                break
+            call["done"].wait()
+            if isinstance(call["error"], own_errors):
+                continue
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+
+        try:
+            call["result"] = fn()
+        except BaseException as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call["done"].set()
+        return call["result"]
+
+upstream_flights = SingleFlight()
+
+# --- Chat Admission Control ---
+
+class AdmissionRejected(Exception):
+    """Raised when a chat request can't be admitted; carries a Retry-After hint in seconds."""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+class ChatScheduler:
+    """Admission control in front of the upstream model.
+
+    Every chat request first spends a token from its user's bucket. Upstream
+    calls then need one of `concurrency` slots; when none is free the caller
+    waits in its user's queue, and freed slots are handed to users in
+    round-robin order so one heavy user can't starve the rest.
+
+    Buckets, queues and slots are per process. `shared_slots`, a semaphore
+    inherited by every forked process, is taken on top of the local slot so
+    the upstream cap holds across prefork workers and background processes.
+    """
+
+    def __init__(self, rate_per_min, burst, concurrency, queue_timeout, queue_max_per_user, shared_slots=None):
+        self.rate = rate_per_min / 60.0
+        self.burst = burst
+        self.concurrency = concurrency
+        self.queue_timeout = queue_timeout
+        self.queue_max_per_user = queue_max_per_user
+        self._shared_slots = shared_slots
+        self._lock = threading.Lock()
+        self._buckets = {}  # user -> [tokens, last_refill]
+        self._active = 0
+        self._queues = collections.OrderedDict()  # user -> deque of waiter events, in service order
+        self._stats = {"admitted": 0, "queued": 0, "rejected_rate": 0, "rejected_queue": 0,
+                       "queue_time_total": 0.0, "queue_time_max": 0.0}
+
+    def take_token(self, user):
+        """Spends one token for `user`; returns 0 if allowed, else seconds until the next token."""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(user)
+            if bucket is None:
+                if len(self._buckets) > 10000:
+                    self._prune_buckets(now)
+                bucket = self._buckets[user] = [float(self.burst), now]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0
+            self._stats["rejected_rate"] += 1
+            return max(1, math.ceil((1 - bucket[0]) / self.rate)) if self.rate > 0 else 60
+
+    def _prune_buckets(self, now):
+        # Buckets that have refilled completely carry no state worth keeping
+        for user, (tokens, last) in list(self._buckets.items()):
+            if tokens + (now - last) * self.rate >= self.burst:
+                del self._buckets[user]
+
+    def acquire(self, user):
+        start = time.monotonic()
+        self._acquire_local(user, start)
+        if self._shared_slots is None:
+            return
+        # Other processes may hold the rest of the global slots; wait out what's left of the queue timeout
+        if not self._shared_slots.acquire(timeout=max(0.0, self.queue_timeout - (time.monotonic() - start))):
+            self._release_local()
+            with self._lock:
+                self._stats["rejected_queue"] += 1
+                raise AdmissionRejected("Server busy", self._retry_hint())
+
+    def _acquire_local(self, user, start):
+        with self._lock:
+            if self._active < self.concurrency and not self._queues:
+                self._active += 1
+                self._record_admit(0.0)
+                return
+            queue = self._queues.get(user)
+            if queue is not None and len(queue) >= self.queue_max_per_user:
+                self._stats["rejected_queue"] += 1
+                raise AdmissionRejected("Too many pending requests", self._retry_hint())
+            waiter = threading.Event()
+            self._queues.setdefault(user, collections.deque()).append(waiter)
+            self._stats["queued"] += 1
+
+        granted = waiter.wait(self.queue_timeout)
+        with self._lock:
+            # The slot may have been handed over right as the wait timed out
+            if not granted and not waiter.is_set():
+                queue = self._queues.get(user)
+                if queue is not None:
+                    queue.remove(waiter)
+                    if not queue:
+                        del self._queues[user]
+                self._stats["rejected_queue"] += 1
+                raise AdmissionRejected("Server busy", self._retry_hint())
+            self._record_admit(time.monotonic() - start)
+
+    def release(self):
+        if self._shared_slots is not None:
+            self._shared_slots.release()
+        self._release_local()
+
+    def _release_local(self):
+        with self._lock:
+            if not self._queues:
+                self._active -= 1
+                return
+            # Serve the user at the head of the rotation, then move them to the back
+            user, queue = next(iter(self._queues.items()))
+            waiter = queue.popleft()
+            del self._queues[user]
+            if queue:
+                self._queues[user] = queue
+            # The slot passes straight to the waiter; _active is unchanged
+            waiter.set()
+
+    def _record_admit(self, waited):
+        self._stats["admitted"] += 1
+        self._stats["queue_time_total"] += waited
+        self._stats["queue_time_max"] = max(self._stats["queue_time_max"], waited)
+
+    def _retry_hint(self):
+        waiting = sum(len(q) for q in self._queues.values())
+        return max(1, math.ceil(self.queue_timeout * waiting / max(1, self.concurrency)))
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["active"] = self._active
+            stats["waiting"] = sum(len(q) for q in self._queues.values())
+            stats["waiting_users"] = len(self._queues)
+        admitted = stats["admitted"] or 1
+        stats["queue_time_avg"] = stats["queue_time_total"] / admitted
+        return stats
+
+def make_upstream_slots(concurrency):
+    # Created at import, i.e. in the prefork master before any fork. A SIGHUP
+    # re-exec makes a fresh one, so draining old workers can briefly add theirs.
+    try:
+        return multiprocessing.BoundedSemaphore(concurrency)
+    except (ImportError, OSError):
+        # No POSIX semaphores on this platform: the cap is per process
+        return threading.BoundedSemaphore(concurrency)
+
+chat_scheduler = ChatScheduler(CHAT_RATE_PER_MIN, CHAT_BURST, UPSTREAM_CONCURRENCY,
+                               CHAT_QUEUE_TIMEOUT, CHAT_QUEUE_MAX_PER_USER,
+                               shared_slots=make_upstream_slots(UPSTREAM_CONCURRENCY))
+
+# --- Sessions ---
+# Token format: base64url(json {"sid", "uid", "exp"}) + "." + base64url(hmac).
+# The signature and expiry are checked without touching the DB; the sessions
+# row (revocation) and the profile fields are only read on an LRU miss.
+
+class KdfBusy(Exception):
+    """Raised when too many password hashes are already queued."""
+
+kdf_executor = concurrent.futures.ThreadPoolExecutor(max_workers=KDF_WORKERS)
+kdf_slots = threading.BoundedSemaphore(KDF_MAX_PENDING)
+
+def run_kdf(fn, *args):
+    # Bounds CPU spent on password hashing so a login burst can't starve other requests
+    if not kdf_slots.acquire(blocking=False):
+        raise KdfBusy()
+    try:
+        return kdf_executor.submit(fn, *args).result()
+    finally:
+        kdf_slots.release()
+
+_session_secret = []
+
+def session_secret():
+    # Loaded on first use rather than at import, which would need the migrated DB
+    if not _session_secret:
+        if SESSION_SECRET:
+            _session_secret.append(SESSION_SECRET.encode('utf-8'))
+        else:
+            conn = sqlite3.connect(DB_FILE)
+            c = conn.cursor()
+            c.execute("SELECT value FROM app_settings WHERE key='session_secret'")
+            row = c.fetchone()
+            conn.close()
+            _session_secret.append(row[0].encode('utf-8'))
+    return _session_secret[0]
+
+def _b64encode(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+def sign_session(claims):
+    body = _b64encode(json.dumps(claims, separators=(',', ':')).encode('utf-8'))
+    sig = hmac.new(session_secret(), body.encode('ascii'), hashlib.sha256).digest()
+    return f"{body}.{_b64encode(sig)}"
+
+def read_session_token(token):
+    """Returns the token's claims if the signature is valid and it hasn't expired."""
+    try:
+        body, sig = token.split('.')
+        expected = hmac.new(session_secret(), body.encode('ascii'), hashlib.sha256).digest()
+        if not hmac.compare_digest(expected, _b64decode(sig)):
+            return None
+        claims = json.loads(_b64decode(body))
+    except (ValueError, UnicodeError):
+        return None
+    if claims.get('exp', 0) < time.time():
+        return None
+    return claims
+
+class TTLCache:
+    """Thread-safe LRU whose entries also expire: key -> (value, cached_at)."""
+
+    def __init__(self, capacity, ttl):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[1] > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+# Validated sessions: sid -> session dict (user id + profile fields)
+session_cache = TTLCache(SESSION_CACHE_SIZE, SESSION_CACHE_TTL)
+
+def issue_session(conn, user_id, username, avatar, signature):
+    """Creates a sessions row on `conn` (caller commits) and returns (token, expires_at)."""
+    sid = secrets.token_hex(16)
+    expires_at = time.time() + SESSION_TTL
+    conn.execute("INSERT INTO sessions (id, user_id, expires_at) VALUES (?, ?, ?)",
+                 (sid, user_id, expires_at))
+    session_cache.put(sid, {"sid": sid, "user_id": user_id, "username": username,
+                            "avatar": avatar, "signature": signature})
+    return sign_session({"sid": sid, "uid": user_id, "exp": int(expires_at)}), expires_at
+
+def validate_session(token):
+    claims = read_session_token(token)
+    if claims is None:
+        return None
+    session = session_cache.get(claims['sid'])
+    if session is not None:
+        return session
+
+    conn = sqlite3.connect(DB_FILE)
+    c = conn.cursor()
+    c.execute('''SELECT u.id, u.username, u.avatar, u.signature FROM sessions s
+                 JOIN users u ON u.id = s.user_id
+                 WHERE s.id=? AND s.revoked=0 AND s.expires_at>?''', (claims['sid'], time.time()))
+    row = c.fetchone()
+    conn.close()
+    if not row:
+        return None
+    session = {"sid": claims['sid'], "user_id": row[0], "username": row[1],
+               "avatar": row[2], "signature": row[3]}
+    session_cache.put(claims['sid'], session)
+    return session
+
+class Unauthorized(Exception):
+    """Raised while resolving the caller; the request is answered with 401."""
+
+_legacy_deadline = (datetime.datetime.strptime(LEGACY_USER_ID_UNTIL, "%Y-%m-%d")
+                    .replace(tzinfo=datetime.timezone.utc).timestamp() if LEGACY_USER_ID_UNTIL else 0)
+
+def legacy_user_id_allowed():
+    return time.time() < _legacy_deadline
+
+def revoke_session(sid):
+    conn = sqlite3.connect(DB_FILE)
+    conn.execute("UPDATE sessions SET revoked=1 WHERE id=?", (sid,))
     conn.commit()
     conn.close()
+    session_cache.discard(sid)
+
+def prune_sessions():
+    """Deletes expired and revoked sessions; their tokens fail validation either way."""
+    conn = sqlite3.connect(DB_FILE, timeout=30)
+    try:
+        deleted = conn.execute("DELETE FROM sessions WHERE revoked=1 OR expires_at<?", (time.time(),)).rowcount
+        conn.commit()
+        return deleted
+    finally:
+        conn.close()
+
+# --- Book Blobs ---
+# Uploads are transcoded to clean UTF-8 by handle_upload. Blobs that predate
+# that (or were copied in by hand) are transcoded on first read, without the
+# text clean-up, and recorded so later reads skip the check.
+
+_utf8_blobs = set()
+
+def record_blob(conn, filename, info, content_hash=None, original_hash=None):
+    conn.execute("INSERT OR REPLACE INTO book_blobs (filepath, encoding, original_size, normalized_size, removed_lines, content_hash, original_hash) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                 (filename, info["encoding"], info["original_size"], info["normalized_size"], info["removed_lines"], content_hash, original_hash))
+
+def ensure_utf8_blob(filename):
+    if filename in _utf8_blobs:
+        return
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        if not conn.execute("SELECT 1 FROM book_blobs WHERE filepath=?", (filename,)).fetchone():
+            path = os.path.join(BOOKS_DIR, filename)
+            with open(path, 'rb') as f:
+                data = f.read()
+            out, info = normalize_book(data, clean=False)
+            if out != data:
+                # Write-then-rename so a concurrent reader never sees a half-written file
+                tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+                with open(tmp_path, 'wb') as f:
+                    f.write(out)
+                os.replace(tmp_path, path)
+            record_blob(conn, filename, info, hashlib.sha256(out).hexdigest())
+            conn.commit()
+    finally:
+        conn.close()
+    _utf8_blobs.add(filename)
+
+def read_book_text(filename):
+    ensure_utf8_blob(filename)
+    with open(os.path.join(BOOKS_DIR, filename), 'r', encoding='utf-8') as f:
+        return f.read()
+
+# --- Book Summaries ---
+# Chapters are detected with the same heading patterns the reader uses for
+# its TOC. Each chapter summary is committed as soon as it is written, so an
+# interrupted pass resumes from the first missing chapter.
+
+CHAPTER_PATTERNS = [
+    re.compile(r'^(第[一二三四五六七八九十百千\d]+[章回节篇].*)', re.M),
+    re.compile(r'^(Chapter\s+\d+.*)', re.M | re.I),
+    re.compile(r'^(\d+[\.、].+)', re.M),
+]
+
+_file_hashes = {}  # path -> (mtime, size, sha256)
+
+def file_hash(path):
+    st = os.stat(path)
+    cached = _file_hashes.get(path)
+    if cached and cached[0] == st.st_mtime and cached[1] == st.st_size:
+        return cached[2]
+    with open(path, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    _file_hashes[path] = (st.st_mtime, st.st_size, digest)
+    return digest
+
+def blob_hash(filename):
+    return file_hash(os.path.join(BOOKS_DIR, filename))
+
+def find_chapter_headings(text):
+    """Returns [(title, start, end)] for the chapter headings in `text` (may be empty)."""
+    chapters = []
+    for pattern in CHAPTER_PATTERNS:
+        matches = list(pattern.finditer(text))
+        if matches:
+            for i, m in enumerate(matches):
+                end = matches[i + 1].start() if i + 1 < len(matches) else len(text)
+                # Headings with (almost) no body are a table of contents, not chapters
+                if end - m.end() >= 200:
+                    chapters.append((m.group(1).strip()[:30], m.start(), end))
+            break
+    return chapters
+
+_book_tocs = {}  # content hash -> [{"title", "offset"}]
+
+def book_toc(filename):
+    # Built once per blob (normally by the ingest job) and kept in book_tocs,
+    # so other processes never rescan the text
+    ensure_utf8_blob(filename)
+    content_hash = blob_hash(filename)
+    toc = _book_tocs.get(content_hash)
+    if toc is not None:
+        return toc
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        row = conn.execute("SELECT toc FROM book_tocs WHERE content_hash=?", (content_hash,)).fetchone()
+        if row:
+            toc = json.loads(row[0])
+        else:
+            text = read_book_text(filename)
+            toc = [{"title": title, "offset": start} for title, start, _ in find_chapter_headings(text)]
+            conn.execute("INSERT OR REPLACE INTO book_tocs (content_hash, toc) VALUES (?, ?)",
+                         (content_hash, json.dumps(toc, ensure_ascii=False)))
+            conn.commit()
+    finally:
+        conn.close()
+    _book_tocs[content_hash] = toc
+    return toc
+
+def detect_chapters(text):
+    """Returns [(title, start, end)] covering the book's chapters."""
+    chapters = find_chapter_headings(text)
+
+    if not chapters:
+        for i, start in enumerate(range(0, len(text), SUMMARY_CHUNK_CHARS)):
+            chapters.append((f"第{i + 1}部分", start, min(start + SUMMARY_CHUNK_CHARS, len(text))))
+
+    if len(chapters) > SUMMARY_MAX_CHAPTERS:
+        group = math.ceil(len(chapters) / SUMMARY_MAX_CHAPTERS)
+        chapters = [(chapters[i][0], chapters[i][1], chapters[min(i + group, len(chapters)) - 1][2])
+                    for i in range(0, len(chapters), group)]
+    return chapters
+
+def summarize_text(prompt):
+    system_instruction = "你是一位细致的文学编辑，擅长用简洁的中文提炼书籍内容。"
+    chat_scheduler.acquire("__summaries__")
+    try:
+        return request_qwen(build_qwen_body(prompt, system_instruction)).strip()
+    finally:
+        chat_scheduler.release()
+
+def summarize_book(filename):
+    ensure_utf8_blob(filename)
+    content_hash = blob_hash(filename)
+    conn = sqlite3.connect(DB_FILE)
+    c = conn.cursor()
+    try:
+        c.execute("SELECT 1 FROM book_summaries WHERE content_hash=?", (content_hash,))
+        if c.fetchone():
+            return
+
+        c.execute("SELECT title FROM books WHERE filepath=? LIMIT 1", (filename,))
+        row = c.fetchone()
+        title = row[0] if row else os.path.splitext(filename)[0]
+
+        text = read_book_text(filename)
+        chapters = detect_chapters(text)
+
+        c.execute("SELECT chapter_index FROM chapter_summaries WHERE content_hash=?", (content_hash,))
+        done = {r[0] for r in c.fetchall()}
+        for index, (chapter_title, start, end) in enumerate(chapters):
+            if index in done:
+                continue
+            excerpt = text[start:end][:SUMMARY_CHAPTER_CHARS]
+            summary = summarize_text(f"请用不超过150字概括《{title}》中「{chapter_title}」这一部分的主要人物与情节：\n\n{excerpt}")
+            c.execute("INSERT OR REPLACE INTO chapter_summaries (content_hash, chapter_index, title, start_offset, summary) VALUES (?, ?, ?, ?, ?)",
+                      (content_hash, index, chapter_title, start, summary))
+            conn.commit()
+
+        c.execute("SELECT title, summary FROM chapter_summaries WHERE content_hash=? ORDER BY chapter_index", (content_hash,))
+        outline = "\n".join(f"{t}：{s}" for t, s in c.fetchall())[:20000]
+        book_summary = summarize_text(f"以下是《{title}》各部分的概要，请据此用不超过400字写出全书梗概，包括主要人物、核心情节与主题：\n\n{outline}")
+        c.execute("INSERT OR REPLACE INTO book_summaries (content_hash, summary, chapter_count) VALUES (?, ?, ?)",
+                  (content_hash, book_summary, len(chapters)))
+        conn.commit()
+    finally:
+        conn.close()
+
+def queue_book_summaries(stop_event=None):
+    """Queues a summarize_book job for every blob in static/books without a summary.
+
+    Only job workers call upstream, so a blob is never summarized by two
+    paths at once; this pass catches blobs that no ingest job queued (the
+    default books, blobs from before the job queue). Returns how many it
+    queued, which is none without DASHSCOPE_API_KEY.
+    """
+    if not DASHSCOPE_API_KEY:
+        return 0
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        done = {row[0] for row in conn.execute("SELECT content_hash FROM book_summaries")}
+    finally:
+        conn.close()
+    queued = 0
+    for filename in sorted(os.listdir(BOOKS_DIR)):
+        if stop_event is not None and stop_event.is_set():
+            break
+        if not filename.endswith('.txt') or blob_hash(filename) in done:
+            continue
+        enqueue_job("summarize_book", {"blob": filename}, priority=JOB_PRIORITY_SUMMARY, unique=True)
+        queued += 1
+    return queued
+
+def run_summary_loop(stop_event):
+    while not stop_event.is_set():
+        try:
+            queue_book_summaries(stop_event)
+        except (sqlite3.Error, OSError) as e:
+            print(f"Summary Error: {e}")
+        stop_event.wait(SUMMARY_INTERVAL)
+
+def get_book_summary(book_id):
+    conn = sqlite3.connect(DB_FILE)
+    c = conn.cursor()
+    try:
+        c.execute("SELECT filepath FROM books WHERE id=?", (book_id,))
+        row = c.fetchone()
+        if not row:
+            return None
+        try:
+            content_hash = blob_hash(row[0])
+        except OSError:
+            return None
+        c.execute("SELECT summary FROM book_summaries WHERE content_hash=?", (content_hash,))
+        row = c.fetchone()
+        return row[0] if row else None
+    finally:
+        conn.close()
+
+# --- Notes ---
+# Sync is cursor based: every write bumps the user's counter in note_seq and
+# stamps the note with it, so "what changed since cursor N" is a range scan
+# on (user_id, seq) whose cost depends on the number of changes only.
+# Conflicts are last-writer-wins on the client's updated_at. Tombstones older
+# than NOTES_TOMBSTONE_TTL are pruned; a cursor from before the last pruned
+# one can't be brought up to date, so that client is told to reset.
+
+NOTE_FIELDS = ("id", "book_id", "paragraph", "start_offset", "end_offset", "quote", "note",
+               "color", "deleted", "updated_at", "seq")
+
+def note_row_to_dict(row):
+    note = dict(zip(NOTE_FIELDS, row))
+    note["deleted"] = bool(note["deleted"])
+    return note
+
+def user_book_blob(c, user_id, book_id):
+    c.execute("SELECT filepath FROM books WHERE id=? AND user_id=?", (book_id, user_id))
+    row = c.fetchone()
+    return row[0] if row else None
+
+def sync_notes(user_id, cursor, changes):
+    """Applies `changes` and returns (changes since `cursor`, new cursor, has_more, reset).
+
+    With reset set the changes start from the beginning (cursor 0), and the
+    client drops its local notes for ones it hasn't sent.
+    """
+    conn = sqlite3.connect(DB_FILE)
+    conn.isolation_level = None
+    c = conn.cursor()
+    try:
+        # Write lock up front: seq allocation must not interleave with another sync
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("SELECT seq, pruned_seq FROM note_seq WHERE user_id=?", (user_id,))
+        row = c.fetchone()
+        seq, pruned_seq = row if row else (0, 0)
+        reset = 0 < cursor < pruned_seq
+        if reset:
+            cursor = 0
+
+        accepted = set()
+        stale = []
+        blobs = {}
+        for change in changes:
+            note_id = change["id"]
+            c.execute("SELECT user_id, updated_at FROM notes WHERE id=?", (note_id,))
+            existing = c.fetchone()
+            if existing and existing[0] != user_id:
+                continue
+            if existing and (existing[1] or 0) > change["updated_at"]:
+                # The server copy is newer; it is sent back below even if the cursor is past it
+                stale.append(note_id)
+                continue
+            book_id = change["book_id"]
+            if book_id not in blobs:
+                blobs[book_id] = user_book_blob(c, user_id, book_id)
+            if blobs[book_id] is None:
+                continue
+            seq += 1
+            c.execute('''INSERT OR REPLACE INTO notes
+                         (id, user_id, book_id, blob, paragraph, start_offset, end_offset,
+                          quote, note, color, deleted, updated_at, seq)
+                         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                      (note_id, user_id, book_id, blobs[book_id], change["paragraph"],
+                       change.get("start_offset"), change.get("end_offset"), change.get("quote"),
+                       change.get("note"), change.get("color"), 1 if change.get("deleted") else 0,
+                       change["updated_at"], seq))
+            accepted.add(note_id)
+        c.execute("INSERT OR REPLACE INTO note_seq (user_id, seq, pruned_seq) VALUES (?, ?, ?)",
+                  (user_id, seq, pruned_seq))
+
+        c.execute("SELECT " + ", ".join(NOTE_FIELDS) + " FROM notes WHERE user_id=? AND seq>? ORDER BY seq LIMIT ?",
+                  (user_id, cursor, NOTES_SYNC_PAGE + 1))
+        rows = c.fetchall()
+        stale_rows = []
+        if stale:
+            c.execute("SELECT " + ", ".join(NOTE_FIELDS) + " FROM notes WHERE user_id=? AND seq<=? AND id IN (" + ",".join("?" * len(stale)) + ")",
+                      [user_id, cursor] + stale)
+            stale_rows = c.fetchall()
+        c.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction:
+            c.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+    has_more = len(rows) > NOTES_SYNC_PAGE
+    rows = rows[:NOTES_SYNC_PAGE]
+    new_cursor = rows[-1][-1] if has_more else seq
+    # The client already has what it just sent; the cursor still moves past it
+    notes = [note_row_to_dict(r) for r in stale_rows + rows if r[0] not in accepted]
+    return notes, new_cursor, has_more, reset
+
+def prune_note_tombstones():
+    """Drops deletes older than NOTES_TOMBSTONE_TTL and records how far each user's went."""
+    cutoff = time.time() - NOTES_TOMBSTONE_TTL
+    conn = sqlite3.connect(DB_FILE, timeout=30)
+    try:
+        conn.execute('''UPDATE note_seq SET pruned_seq = MAX(pruned_seq,
+                            (SELECT MAX(seq) FROM notes
+                             WHERE notes.user_id = note_seq.user_id AND deleted=1 AND updated_at<?))
+                        WHERE user_id IN (SELECT user_id FROM notes WHERE deleted=1 AND updated_at<?)''',
+                     (cutoff, cutoff))
+        conn.execute("DELETE FROM notes WHERE deleted=1 AND updated_at<?", (cutoff,))
+        conn.commit()
+    finally:
+        conn.close()
+
+def parse_note_change(change):
+    """Validates one client change; returns a clean dict or None."""
+    if not isinstance(change, dict):
+        return None
+    note_id, book_id = change.get("id"), change.get("book_id")
+    paragraph, updated_at = change.get("paragraph"), change.get("updated_at")
+    if not isinstance(note_id, str) or not 0 < len(note_id) <= 64 or not isinstance(book_id, str):
+        return None
+    if not isinstance(paragraph, int) or paragraph < 0 or not isinstance(updated_at, (int, float)):
+        return None
+    clean = {"id": note_id, "book_id": book_id, "paragraph": paragraph, "updated_at": float(updated_at),
+             "deleted": bool(change.get("deleted"))}
+    for key in ("start_offset", "end_offset"):
+        clean[key] = change.get(key) if isinstance(change.get(key), int) else None
+    for key, limit in (("quote", 2000), ("note", 10000), ("color", 32)):
+        clean[key] = change.get(key)[:limit] if isinstance(change.get(key), str) else None
+    return clean
+
+# --- Reading Stats ---
+# One user_stats row per reader, kept current by the triggers from
+# migrate_user_stats, so the profile reads a row instead of scanning the
+# shelf. `python run_app.py stats check` compares the rows with a full
+# recomputation; `stats rebuild` replaces them with it.
+
+USER_STATS_FIELDS = ("books", "finished", "reading", "pages_read", "days_read", "streak", "first_day", "last_day")
+EMPTY_USER_STATS = (0, 0, 0, 0, 0, 0, None, None)
+
+def load_app_timezone(name):
+    try:
+        return zoneinfo.ZoneInfo(name)
+    except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+        pass
+    if name == "Asia/Shanghai":
+        # No tz database on this image (pip install tzdata); Beijing has no DST
+        print("Timezone Error: no tz database, counting reading days in fixed UTC+8 for Asia/Shanghai")
+        return datetime.timezone(datetime.timedelta(hours=8), "UTC+8")
+    # Any other zone has no safe fixed offset: its days would be off by hours
+    print(f"Timezone Error: unknown APP_TIMEZONE {name!r} (misspelt, or pip install tzdata), "
+          "counting reading days in UTC")
+    return datetime.timezone.utc
+
+APP_TZ = load_app_timezone(APP_TIMEZONE)
+
+def app_today():
+    return datetime.datetime.now(APP_TZ).date()
+
+def reading_streak(days):
+    # Length of the run of consecutive days ending at the last one (days sorted)
+    streak = 0
+    previous = None
+    for day in days:
+        current = datetime.date.fromisoformat(day)
+        streak = streak + 1 if previous and current - previous == datetime.timedelta(days=1) else 1
+        previous = current
+    return streak
+
+def compute_user_stats(c):
+    stats = {}
+    for user_id, books, finished, reading, pages_read in c.execute(
+            '''SELECT user_id, COUNT(*), SUM(IFNULL(progress, 0) >= 100),
+                      SUM(IFNULL(progress, 0) BETWEEN 1 AND 99), SUM(IFNULL(pages_read, 0))
+               FROM books WHERE user_id IS NOT NULL GROUP BY user_id''').fetchall():
+        stats[user_id] = (books, finished, reading, pages_read, 0, 0, None, None)
+    days_by_user = collections.defaultdict(list)
+    for user_id, day in c.execute("SELECT user_id, day FROM reading_days ORDER BY user_id, day").fetchall():
+        days_by_user[user_id].append(day)
+    for user_id, days in days_by_user.items():
+        counts = stats.get(user_id, EMPTY_USER_STATS)[:4]
+        stats[user_id] = counts + (len(days), reading_streak(days), days[0], days[-1])
+    return stats
+
+def rebuild_user_stats(c):
+    stats = compute_user_stats(c)
+    c.execute("DELETE FROM user_stats")
+    c.executemany(f"INSERT INTO user_stats (user_id, {', '.join(USER_STATS_FIELDS)}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                  ((user_id,) + row for user_id, row in stats.items()))
+    return len(stats)
+
+def check_user_stats(c):
+    """Returns (user_id, expected, stored) for every row the triggers got wrong."""
+    expected = compute_user_stats(c)
+    stored = {row[0]: tuple(row[1:]) for row in
+              c.execute(f"SELECT user_id, {', '.join(USER_STATS_FIELDS)} FROM user_stats").fetchall()}
+    # A reader whose books were all removed keeps a row of zeros
+    return [(user_id, expected.get(user_id, EMPTY_USER_STATS), stored.get(user_id, EMPTY_USER_STATS))
+            for user_id in sorted(expected.keys() | stored.keys())
+            if expected.get(user_id, EMPTY_USER_STATS) != stored.get(user_id, EMPTY_USER_STATS)]
+
+def user_stats_dict(row):
+    stats = dict(zip(USER_STATS_FIELDS, row or EMPTY_USER_STATS))
+    today = app_today()
+    last_day = stats.pop("last_day")
+    first_day = stats.pop("first_day")
+    # The stored streak is as of the last reading day; a missed day ends it
+    if not last_day or datetime.date.fromisoformat(last_day) < today - datetime.timedelta(days=1):
+        stats["streak"] = 0
+    # 书龄: days since the first day with reading recorded
+    stats["reading_age_days"] = (today - datetime.date.fromisoformat(first_day)).days + 1 if first_day else 0
+    return stats
+
+def get_user_stats(c, user_id):
+    c.execute(f"SELECT {', '.join(USER_STATS_FIELDS)} FROM user_stats WHERE user_id=?", (user_id,))
+    return user_stats_dict(c.fetchone())
+
+def record_progress(user_id, book_id, progress, page):
+    """Stores how far the reader got in a book and marks today as a reading day."""
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        # Furthest point reached, so paging back doesn't undo 已读
+        updated = conn.execute('''UPDATE books SET progress=MAX(IFNULL(progress, 0), ?),
+                                                   pages_read=MAX(IFNULL(pages_read, 0), ?)
+                                   WHERE id=? AND user_id=?''', (progress, page, book_id, user_id)).rowcount
+        if updated:
+            conn.execute("INSERT OR IGNORE INTO reading_days (user_id, day) VALUES (?, ?)",
+                         (user_id, app_today().isoformat()))
+        conn.commit()
+        return updated > 0
+    finally:
+        conn.close()
+
+# --- Soulmates ---
+# A full pass reads every shelf once (ordered by the idx_books_user index),
+# builds the sparse taste matrix and writes each user's top matches in
+# batches. Rows are replaced in place, so readers always see a complete
+# list, and rows left over from users without books are dropped at the end.
+
+def compute_soulmates(stop_event=None):
+    started = time.time()
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        index = TasteIndex(conn.execute("SELECT user_id, title, progress FROM books ORDER BY user_id"))
+        for start in range(0, index.user_count, SOULMATE_BATCH):
+            if stop_event is not None and stop_event.is_set():
+                return
+            batch = [(index.user_ids[u], index.neighbours(u, SOULMATE_TOP_K))
+                     for u in range(start, min(start + SOULMATE_BATCH, index.user_count))]
+
+            # Profile fields are copied into the row so serving is a single lookup
+            wanted = list({user_id for _, matches in batch for user_id, _, _ in matches})
+            profiles = {}
+            for i in range(0, len(wanted), 500):
+                chunk = wanted[i:i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                for row in conn.execute(f"SELECT id, username, avatar, signature FROM users WHERE id IN ({placeholders})", chunk):
+                    profiles[row[0]] = row[1:]
+
+            now = time.time()
+            rows = []
+            for user_id, matches in batch:
+                entries = []
+                for match_id, score, shared in matches:
+                    if match_id not in profiles:
+                        continue
+                    username, avatar, signature = profiles[match_id]
+                    entries.append({"username": username, "avatar": avatar or "default_avatar_1.svg",
+                                    "signature": signature or "懂书也懂你", "score": score,
+                                    "shared_books": shared})
+                rows.append((user_id, json.dumps(entries, ensure_ascii=False), now))
+            conn.executemany("INSERT OR REPLACE INTO soulmates (user_id, matches, computed_at) VALUES (?, ?, ?)", rows)
+            conn.commit()
+
+        conn.execute("DELETE FROM soulmates WHERE computed_at < ?", (started,))
+        conn.commit()
+        print(f"Soulmates computed for {index.user_count} users in {time.time() - started:.1f}s")
+    finally:
+        conn.close()
+
+def run_soulmate_loop(stop_event):
+    while not stop_event.is_set():
+        try:
+            compute_soulmates(stop_event)
+        except sqlite3.Error as e:
+            print(f"Soulmate Error: {e}")
+        stop_event.wait(SOULMATE_INTERVAL)
+
+def get_soulmates(user_id):
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        row = conn.execute("SELECT matches, computed_at FROM soulmates WHERE user_id=?", (user_id,)).fetchone()
+    finally:
+        conn.close()
+    if not row:
+        return {"soulmates": [], "computed_at": None}
+    return {"soulmates": json.loads(row[0]), "computed_at": row[1]}
 
-init_db()
+# --- Backups ---
+# Scheduled with BACKUP_INTERVAL; backup.py also runs standalone and restores.
+
+def run_backup_loop(stop_event):
+    while not stop_event.wait(BACKUP_INTERVAL):
+        try:
+            manifest = create_backup(DB_FILE, BOOKS_DIR)
+            print(f"Backup {manifest['name']} written in {manifest['db']['seconds']}s")
+        except (OSError, sqlite3.Error, RuntimeError) as e:
+            print(f"Backup Error: {e}")
+
+# --- Bootstrap ---
+# Everything the bookshelf and profile pages need on load, read in one
+# transaction and cached per user until that user writes.
+
+bootstrap_cache = TTLCache(BOOTSTRAP_CACHE_SIZE, BOOTSTRAP_CACHE_TTL)
+
+def build_bootstrap(user_id):
+    conn = sqlite3.connect(DB_FILE)
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+    try:
+        # One read transaction so profile, shelf and current book are consistent
+        c.execute("BEGIN")
+        c.execute("SELECT username, avatar, signature, current_book_id FROM users WHERE id=?", (user_id,))
+        user = c.fetchone()
+        if not user:
+            return None
+        c.execute("SELECT id, title, author, progress, filepath FROM books WHERE user_id=? ORDER BY added_at DESC", (user_id,))
+        rows = c.fetchall()
+        stats = get_user_stats(c, user_id)
+        conn.commit()
+    finally:
+        conn.close()
+
+    books = [{"id": r["id"], "title": r["title"], "author": r["author"], "progress": r["progress"]} for r in rows]
+    # Same fallback as /api/current_book: the stored current book, else the newest one
+    current = next((r for r in rows if r["id"] == user["current_book_id"]), rows[0] if rows else None)
+    current_book = {"book_id": None}
+    if current:
+        try:
+            toc = book_toc(current["filepath"])
+        except OSError:
+            toc = []
+        current_book = {"book_id": current["id"], "title": current["title"], "author": current["author"],
+                        "progress": current["progress"], "toc": toc}
+
+    return {
+        "profile": {
+            "username": user["username"],
+            "avatar": user["avatar"] or "default_avatar_1.svg",
+            "signature": user["signature"] or "懂书也懂你"
+        },
+        "stats": stats,
+        "books": books,
+        "current_book": current_book,
+    }
+
+# --- Background Jobs ---
+# A persistent queue in the jobs table. Workers claim the highest-priority
+# due job under a lease that a heartbeat keeps extending, so a job whose
+# worker died becomes claimable again once the lease runs out. Failures are
+# retried with exponential backoff up to max_attempts. Multi-stage jobs save
+# their state after every stage, so a retry resumes where the last attempt
+# stopped.
+
+jobs_wakeup = threading.Event()  # set by enqueue_job so idle workers in this process start at once
+
+class LeaseLost(Exception):
+    pass
+
+class Job:
+    def __init__(self, row, worker_id=None):
+        self.id, self.kind, self.user_id, payload, state, self.attempts, self.max_attempts = row
+        self.payload = json.loads(payload or "{}")
+        self.state = json.loads(state or "{}")
+        self.worker_id = worker_id
+
+    def save(self, stage, progress):
+        # Only while we hold the lease; once it ran out the job may be another worker's
+        conn = sqlite3.connect(DB_FILE)
+        try:
+            updated = conn.execute("UPDATE jobs SET stage=?, progress=?, state=?, updated_at=? WHERE id=? AND locked_by=?",
+                                   (stage, progress, json.dumps(self.state, ensure_ascii=False), time.time(),
+                                    self.id, self.worker_id)).rowcount
+            conn.commit()
+        finally:
+            conn.close()
+        if not updated:
+            raise LeaseLost(f"Lease on job {self.id} lost")
+
+def enqueue_job(kind, payload, user_id=None, priority=0, max_attempts=JOB_MAX_ATTEMPTS, unique=False):
+    """Returns the new job's id; with unique, the id of an identical job still pending instead."""
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    payload = json.dumps(payload, ensure_ascii=False)
+    conn = sqlite3.connect(DB_FILE, timeout=30)
+    conn.isolation_level = None
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        if unique:
+            row = conn.execute("SELECT id FROM jobs WHERE kind=? AND payload=? AND status IN ('queued', 'running')",
+                               (kind, payload)).fetchone()
+            if row:
+                conn.execute("COMMIT")
+                return row[0]
+        conn.execute('''INSERT INTO jobs (id, kind, user_id, payload, state, priority, max_attempts, run_after, created_at, updated_at)
+                        VALUES (?, ?, ?, ?, '{}', ?, ?, ?, ?, ?)''',
+                     (job_id, kind, user_id, payload, priority, max_attempts, now, now, now))
+        conn.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    jobs_wakeup.set()
+    return job_id
+
+def claim_job(worker_id):
+    conn = sqlite3.connect(DB_FILE, timeout=30)
+    conn.isolation_level = None
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        now = time.time()
+        # Leases that ran out belong to workers that died mid-job; a job that
+        # keeps killing its worker fails once it is out of attempts
+        conn.execute('''UPDATE jobs SET status='failed', error='Worker died mid-job', locked_by=NULL, locked_until=NULL,
+                        updated_at=? WHERE status='running' AND locked_until<? AND attempts>=max_attempts''', (now, now))
+        conn.execute("UPDATE jobs SET status='queued', locked_by=NULL WHERE status='running' AND locked_until<?", (now,))
+        row = conn.execute('''SELECT id, kind, user_id, payload, state, attempts, max_attempts FROM jobs
+                              WHERE status='queued' AND run_after<=? ORDER BY priority DESC, created_at LIMIT 1''',
+                           (now,)).fetchone()
+        if row is None:
+            conn.execute("COMMIT")
+            return None
+        conn.execute("UPDATE jobs SET status='running', attempts=attempts+1, locked_by=?, locked_until=?, updated_at=? WHERE id=?",
+                     (worker_id, now + JOB_LEASE, now, row[0]))
+        conn.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    job = Job(row, worker_id)
+    job.attempts += 1
+    return job
+
+def finish_job(job, status, result=None, error=None, run_after=None):
+    # A worker whose lease ran out must not overwrite the worker that reclaimed the job
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        updated = conn.execute('''UPDATE jobs SET status=?, result=?, error=?, run_after=COALESCE(?, run_after),
+                                  progress=CASE WHEN ?='done' THEN 1 ELSE progress END,
+                                  locked_by=NULL, locked_until=NULL, updated_at=? WHERE id=? AND locked_by=?''',
+                               (status, json.dumps(result, ensure_ascii=False) if result is not None else None,
+                                error, run_after, status, time.time(), job.id, job.worker_id)).rowcount
+        conn.commit()
+    finally:
+        conn.close()
+    if not updated:
+        print(f"Job {job.kind} {job.id}: lease lost, {status} not recorded")
+    return updated > 0
+
+def run_job(job, worker_id):
+    handler = JOB_HANDLERS.get(job.kind)
+    if handler is None:
+        finish_job(job, 'failed', error=f"Unknown job kind: {job.kind}")
+        return
+
+    done = threading.Event()
+    def heartbeat():
+        # A failed beat (e.g. database locked) is retried on the next one; the lease outlasts two misses
+        while not done.wait(JOB_LEASE / 3):
+            try:
+                conn = sqlite3.connect(DB_FILE)
+                try:
+                    conn.execute("UPDATE jobs SET locked_until=? WHERE id=? AND locked_by=?",
+                                 (time.time() + JOB_LEASE, job.id, worker_id))
+                    conn.commit()
+                finally:
+                    conn.close()
+            except sqlite3.Error as e:
+                print(f"Job Heartbeat Error ({job.kind} {job.id}): {e}")
+    threading.Thread(target=heartbeat, daemon=True).start()
+
+    try:
+        result = handler(job)
+    except LeaseLost as e:
+        print(f"Job Error ({job.kind} {job.id}): {e}, leaving it to the worker that reclaimed it")
+    except Exception as e:
+        print(f"Job Error ({job.kind} {job.id}, attempt {job.attempts}): {e}")
+        if job.attempts >= job.max_attempts:
+            finish_job(job, 'failed', error=str(e))
+        else:
+            finish_job(job, 'queued', error=str(e),
+                       run_after=time.time() + JOB_RETRY_DELAY * 2 ** (job.attempts - 1))
+    else:
+        finish_job(job, 'done', result=result)
+    finally:
+        done.set()
+
+def run_job_worker(stop_event, worker_id):
+    while not stop_event.is_set():
+        try:
+            job = claim_job(worker_id)
+        except sqlite3.Error as e:
+            print(f"Job Queue Error: {e}")
+            job = None
+        if job is None:
+            jobs_wakeup.wait(JOB_POLL_INTERVAL)
+            jobs_wakeup.clear()
+            continue
+        # Recording the outcome can hit a locked database too; the lease then
+        # runs out and the job is retried, but this worker thread lives on
+        try:
+            run_job(job, worker_id)
+        except sqlite3.Error as e:
+            print(f"Job Queue Error ({job.kind} {job.id}): {e}")
+
+def prune_jobs():
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        conn.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at<?", (time.time() - JOB_RETENTION,))
+        conn.commit()
+        pending = {json.loads(payload).get("raw_file") for (payload,) in
+                   conn.execute("SELECT payload FROM jobs WHERE kind='ingest_book' AND status IN ('queued', 'running')")}
+    finally:
+        conn.close()
+    # Uploads no live job will read: failed ingests, and uploads whose enqueue
+    # never happened. Young files may belong to an upload being enqueued right now.
+    if not os.path.isdir(INCOMING_DIR):
+        return
+    for name in os.listdir(INCOMING_DIR):
+        path = os.path.join(INCOMING_DIR, name)
+        try:
+            if name not in pending and os.path.getmtime(path) < time.time() - JOB_LEASE:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def run_job_workers(stop_event):
+    threads = [threading.Thread(target=run_job_worker, args=(stop_event, f"{os.getpid()}-{i}"), daemon=True)
+               for i in range(max(JOB_WORKERS, 1))]
+    for thread in threads:
+        thread.start()
+    while True:
+        try:
+            prune_jobs()
+            prune_note_tombstones()
+            prune_sessions()
+        except (sqlite3.Error, OSError) as e:
+            print(f"Job Queue Error: {e}")
+        if stop_event.wait(3600):
+            break
+    # Let running jobs finish; anything cut off is reclaimed after its lease
+    for thread in threads:
+        thread.join(GRACEFUL_TIMEOUT)
+
+def get_job(job_id):
+    conn = sqlite3.connect(DB_FILE)
+    conn.row_factory = sqlite3.Row
+    try:
+        row = conn.execute('''SELECT id, kind, user_id, status, stage, progress, attempts, max_attempts,
+                                     error, result, created_at, updated_at FROM jobs WHERE id=?''', (job_id,)).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        return None
+    job = dict(row)
+    job["result"] = json.loads(job["result"]) if job["result"] else None
+    return job
+
+# --- Book Ingest ---
+# An upload is stored raw in INCOMING_DIR and handed to an ingest_book job:
+# transcode to clean UTF-8, reuse an identical blob if one is stored
+# already, add the book to the shelf, then build the TOC. The book summary
+# is queued as its own lower-priority job. Every stage can run again after
+# a crash without duplicating work: the blob name and book id derive from
+# the job id.
+
+def ingest_transcode(job):
+    raw_path = os.path.join(INCOMING_DIR, job.payload["raw_file"])
+    with open(raw_path, 'rb') as f:
+        data = f.read()
+    normalized, info = normalize_book(data)
+    filename = f"{job.id}_{os.path.basename(job.payload['filename'])}"
+    path = os.path.join(BOOKS_DIR, filename)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(normalized)
+    os.replace(tmp_path, path)
+    job.state.update(blob=filename, info=info, content_hash=hashlib.sha256(normalized).hexdigest(),
+                     original_hash=hashlib.sha256(data).hexdigest())
+
+def ingest_dedup(job):
+    # Clean-up drops lines, so the upload is kept as received; identical
+    # uploads share one copy
+    raw_path = os.path.join(INCOMING_DIR, job.payload["raw_file"])
+    if os.path.exists(raw_path):
+        os.makedirs(ORIGINALS_DIR, exist_ok=True)
+        os.replace(raw_path, os.path.join(ORIGINALS_DIR, job.state["original_hash"]))
+    conn = sqlite3.connect(DB_FILE, timeout=30)
+    conn.isolation_level = None
+    try:
+        # IMMEDIATE so two identical uploads ingested at once can't both miss each other
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute("SELECT filepath FROM book_blobs WHERE content_hash=? AND filepath!=? LIMIT 1",
+                           (job.state["content_hash"], job.state["blob"])).fetchone()
+        if row and os.path.exists(os.path.join(BOOKS_DIR, row[0])):
+            conn.execute("COMMIT")
+            try:
+                os.remove(os.path.join(BOOKS_DIR, job.state["blob"]))
+            except FileNotFoundError:
+                pass
+            job.state.update(blob=row[0], deduplicated=True)
+        else:
+            record_blob(conn, job.state["blob"], job.state["info"], job.state["content_hash"],
+                        job.state.get("original_hash"))
+            conn.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+def ingest_catalog(job):
+    user_id = job.payload["user_id"]
+    book_id = str(uuid.UUID(job.id))
+    # Simplified title from filename
+    title = os.path.splitext(job.payload["filename"])[0]
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        conn.execute("INSERT OR IGNORE INTO books (id, user_id, title, author, filepath) VALUES (?, ?, ?, ?, ?)",
+                     (book_id, user_id, title, job.payload.get("author", "Unknown"), job.state["blob"]))
+        conn.commit()
+    finally:
+        conn.close()
+    bootstrap_cache.discard(user_id)
+    job.state["book_id"] = book_id
+
+def ingest_toc(job):
+    book_toc(job.state["blob"])
+
+INGEST_STAGES = [
+    ("transcode", ingest_transcode),
+    ("dedup", ingest_dedup),
+    ("catalog", ingest_catalog),
+    ("toc", ingest_toc),
+]
+
+def run_ingest_job(job):
+    for index, (stage, fn) in enumerate(INGEST_STAGES):
+        if index < job.state.get("stages_done", 0):
+            continue
+        job.save(stage, index / len(INGEST_STAGES))
+        fn(job)
+        job.state["stages_done"] = index + 1
+        job.save(stage, (index + 1) / len(INGEST_STAGES))
+
+    # A deduplicated blob got its summary job when it was first ingested
+    if BOOK_SUMMARIES and DASHSCOPE_API_KEY and not job.state.get("deduplicated") and not job.state.get("summary_job"):
+        job.state["summary_job"] = enqueue_job("summarize_book", {"blob": job.state["blob"]},
+                                               priority=JOB_PRIORITY_SUMMARY, unique=True)
+        job.save("done", 1)
+    return {"book_id": job.state["book_id"], "encoding": job.state["info"]["encoding"],
+            "deduplicated": job.state.get("deduplicated", False)}
+
+def run_summary_job(job):
+    # Queued while a key was set: finish without calling upstream rather than
+    # fail every attempt. The summary pass queues the blob again once there is one.
+    if not DASHSCOPE_API_KEY:
+        return {"skipped": "DASHSCOPE_API_KEY is not set"}
+    summarize_book(job.payload["blob"])
+
+JOB_HANDLERS = {
+    "ingest_book": run_ingest_job,
+    "summarize_book": run_summary_job,
+}
+
+# --- Asset Manifest ---
+# Pages and static files the service worker precaches, with their content
+# hashes. The version covers all of them plus sw.js itself, and is written
+# into the served sw.js, so any change makes the browser install a new cache.
+
+STATIC_DIR = os.path.join(BASE_DIR, "static")
+SERVICE_WORKER_FILE = os.path.join(BASE_DIR, "sw.js")
+ASSET_SKIP_DIRS = {"books"}                        # cached per opened book instead
+ASSET_RUNTIME_EXTS = ('.woff2', '.woff', '.ttf')   # font slices, loaded on demand by unicode-range
+
+def asset_manifest():
+    assets = {}
+    for route, filename in ROUTE_MAP.items():
+        if route == "/":
+            continue  # redirects to /login
+        assets[route] = file_hash(os.path.join(BASE_DIR, filename))[:16]
+    for root, dirs, files in os.walk(STATIC_DIR):
+        dirs[:] = sorted(d for d in dirs if d not in ASSET_SKIP_DIRS)
+        for name in sorted(files):
+            if name.endswith(ASSET_RUNTIME_EXTS):
+                continue
+            path = os.path.join(root, name)
+            assets["/" + os.path.relpath(path, BASE_DIR).replace(os.sep, "/")] = file_hash(path)[:16]
+    digest = hashlib.sha256(json.dumps(assets, sort_keys=True).encode('utf-8'))
+    digest.update(file_hash(SERVICE_WORKER_FILE).encode('utf-8'))
+    return {"version": digest.hexdigest()[:16], "assets": assets}
 
 # --- Server Handler ---
 
@@ -121,12 +1750,47 @@ ROUTE_MAP = {
 }
 
 class MyHandler(http.server.SimpleHTTPRequestHandler):
+    # HTTP/1.1 keeps the connection open between API calls; every response
+    # must therefore carry a Content-Length so the client knows where it ends.
+    protocol_version = "HTTP/1.1"
+    # Idle timeout: applied to the socket, so a quiet keep-alive connection is closed
+    timeout = KEEPALIVE_TIMEOUT
+    # Headers and body go out in separate writes; don't let Nagle delay the body
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.requests_served = 0
+
+    def send_response(self, code, message=None):
+        super().send_response(code, message)
+        self.requests_served += 1
+        if self.close_connection:
+            return
+        if self.requests_served >= KEEPALIVE_MAX_REQUESTS:
+            # Setting this header also flips self.close_connection
+            self.send_header('Connection', 'close')
+        else:
+            self.send_header('Keep-Alive', f"timeout={KEEPALIVE_TIMEOUT}, max={KEEPALIVE_MAX_REQUESTS - self.requests_served}")
+
+    def send_error(self, code, message=None, explain=None):
+        # The base class always closes after an error; mark it up front so
+        # send_response doesn't advertise Keep-Alive on the same response.
+        self.close_connection = True
+        super().send_error(code, message, explain)
+
     def log_message(self, format, *args):
         # Silence logs to keep output clean, or uncomment for debugging
         # sys.stderr.write("%s - - [%s] %s\n" % (self.client_address[0], self.log_date_time_string(), format%args))
         pass
 
     def do_GET(self):
+        try:
+            self.route_get()
+        except Unauthorized as e:
+            self.send_json_response(401, {"error": str(e)})
+
+    def route_get(self):
         path = self.path.split('?')[0]
         query = ""
         if '?' in self.path:
@@ -135,9 +1799,29 @@ class MyHandler(http.server.SimpleHTTPRequestHandler):
         if path == "/":
             self.send_response(302)
             self.send_header('Location', '/login')
+            self.send_header('Content-Length', '0')
             self.end_headers()
             return
 
+        # Health: the port is bound before migrations finish, so report readiness separately
+        if path == "/healthz":
+            if db_ready.is_set():
+                self.send_json_response(200, {"status": "ok"})
+            else:
+                self.send_json_response(503, {"status": "starting"}, headers={'Retry-After': '1'})
+            return
+
+        if path.startswith("/api/") and not self.check_ready():
+            return
+
+        # Service worker and the asset list it precaches
+        if path == "/sw.js":
+            self.serve_service_worker()
+            return
+        if path == "/asset-manifest.json":
+            self.send_json_response(200, asset_manifest(), headers={'Cache-Control': 'no-cache'})
+            return
+
         # API: Get Books
         if path == "/api/books":
             self.handle_get_books(query)
@@ -158,6 +1842,32 @@ class MyHandler(http.server.SimpleHTTPRequestHandler):
             self.handle_get_user_profile(query)
             return
 
+        # API: Notes for a paragraph range of one book
+        if path == "/api/notes":
+            self.handle_get_notes(query)
+            return
+
+        # API: Everything the bookshelf/profile pages need, in one response
+        if path == "/api/bootstrap":
+            self.handle_bootstrap()
+            return
+
+        # API: Background job status
+        if path.startswith("/api/jobs/"):
+            self.handle_get_job(path[len("/api/jobs/"):])
+            return
+
+        # API: Readers with similar taste
+        if path == "/api/soulmates":
+            self.handle_get_soulmates()
+            return
+
+        # API: Chat admission metrics (logged-in users only)
+        if path == "/api/chat_metrics":
+            self.resolve_user_id(None)
+            self.send_json_response(200, chat_scheduler.snapshot())
+            return
+
         if path in ROUTE_MAP:
             self.serve_file(ROUTE_MAP[path])
         else:
@@ -173,6 +1883,9 @@ class MyHandler(http.server.SimpleHTTPRequestHandler):
             content_length = int(self.headers['Content-Length'])
             post_data = self.rfile.read(content_length)
             data = json.loads(post_data.decode('utf-8'))
+
+            if not self.check_ready():
+                return
             
             if self.path == '/api/register':
                 self.handle_register(data)
@@ -184,13 +1897,56 @@ class MyHandler(http.server.SimpleHTTPRequestHandler):
                 self.handle_upload(data)
             elif self.path == '/api/update_current_book':
                 self.handle_update_current_book(data)
+            elif self.path == '/api/progress':
+                self.handle_update_progress(data)
+            elif self.path == '/api/logout':
+                self.handle_logout(data)
+            elif self.path == '/api/notes/sync':
+                self.handle_sync_notes(data)
             else:
                 self.send_error(404, "API not found")
+        except Unauthorized as e:
+            self.send_json_response(401, {"error": str(e)})
         except Exception as e:
             self.send_error(500, str(e))
 
     # --- API Handlers ---
 
+    def check_ready(self):
+        if db_ready.is_set():
+            return True
+        self.send_json_response(503, {"error": "Server starting"}, headers={'Retry-After': '1'})
+        return False
+
+    def get_session(self):
+        auth = self.headers.get('Authorization', '')
+        if auth.startswith('Bearer '):
+            return validate_session(auth[len('Bearer '):].strip())
+        return None
+
+    def client_ip(self):
+        # Each trusted proxy appends the address it received from; entries
+        # further left are whatever the client sent and can be forged
+        forwarded = [part.strip() for part in self.headers.get('X-Forwarded-For', '').split(',') if part.strip()]
+        if TRUSTED_PROXIES and forwarded:
+            return forwarded[-min(TRUSTED_PROXIES, len(forwarded))]
+        return self.client_address[0]
+
+    def resolve_user_id(self, fallback_user_id, required=True):
+        # A token that fails validation (revoked, expired, forged) is a 401,
+        # never a cue to trust the user_id the client sent. Without a token the
+        # raw user_id only counts during the LEGACY_USER_ID_UNTIL window.
+        if self.headers.get('Authorization'):
+            session = self.get_session()
+            if not session:
+                raise Unauthorized("Session expired, please log in again")
+            return session['user_id']
+        if fallback_user_id and legacy_user_id_allowed():
+            return fallback_user_id
+        if required:
+            raise Unauthorized("Login required")
+        return None
+
     def handle_register(self, data):
         username = data.get('username', '').strip()
         password = data.get('password', '').strip()
@@ -201,10 +1957,15 @@ class MyHandler(http.server.SimpleHTTPRequestHandler):
             self.send_json_response(400, {"error": "Missing fields"})
             return
 
+        try:
+            pwd_hash = run_kdf(hash_password, password)
+        except KdfBusy:
+            self.send_json_response(503, {"error": "Server busy"}, headers={'Retry-After': '1'})
+            return
+
         conn = sqlite3.connect(DB_FILE)
         c = conn.cursor()
         try:
-            pwd_hash = hashlib.sha256(password.encode()).hexdigest()
             user_id = str(uuid.uuid4())
             c.execute("INSERT INTO users (id, username, password, avatar, signature) VALUES (?, ?, ?, ?, ?)",
                       (user_id, username, pwd_hash, avatar, signature))
@@ -216,8 +1977,10 @@ class MyHandler(http.server.SimpleHTTPRequestHandler):
                           (book_id, user_id, title, author, filename))
             # -----------------------------------------------
 
+            token, expires_at = issue_session(conn, user_id, username, avatar, signature)
             conn.commit()
-            self.send_json_response(200, {"message": "Success", "user_id": user_id})
+            self.send_json_response(200, {"message": "Success", "user_id": user_id,
+                                          "token": token, "expires_at": int(expires_at)})
         except sqlite3.IntegrityError:
             self.send_json_response(400, {"error": "Username taken"})
         except Exception as e:
@@ -232,24 +1995,43 @@ class MyHandler(http.server.SimpleHTTPRequestHandler):
         
         conn = sqlite3.connect(DB_FILE)
         c = conn.cursor()
-        pwd_hash = hashlib.sha256(password.encode()).hexdigest()
-        c.execute("SELECT id, avatar, signature FROM users WHERE username=? AND password=?", (username, pwd_hash))
-        user = c.fetchone()
-        conn.close()
+        try:
+            c.execute("SELECT id, avatar, signature, password FROM users WHERE username=?", (username,))
+            user = c.fetchone()
 
-        if user:
-            # Return more info for caching
-            self.send_json_response(200, {
-                "message": "Login successful", 
-                "user_id": user[0],
-                "avatar": user[1],
-                "signature": user[2]
-            })
-        else:
-            self.send_json_response(401, {"error": "Invalid credentials"})
+            try:
+                valid = user is not None and run_kdf(verify_password, password, user[3])
+                if valid and password_needs_rehash(user[3]):
+                    c.execute("UPDATE users SET password=? WHERE id=?", (run_kdf(hash_password, password), user[0]))
+            except KdfBusy:
+                self.send_json_response(503, {"error": "Server busy"}, headers={'Retry-After': '1'})
+                return
+
+            if valid:
+                token, expires_at = issue_session(conn, user[0], username, user[1], user[2])
+                conn.commit()
+                # Return more info for caching
+                self.send_json_response(200, {
+                    "message": "Login successful", 
+                    "user_id": user[0],
+                    "avatar": user[1],
+                    "signature": user[2],
+                    "token": token,
+                    "expires_at": int(expires_at)
+                })
+            else:
+                self.send_json_response(401, {"error": "Invalid credentials"})
+        finally:
+            conn.close()
+
+    def handle_logout(self, data):
+        session = self.get_session()
+        if session:
+            revoke_session(session['sid'])
+        self.send_json_response(200, {"success": True})
 
     def handle_upload(self, data):
-        user_id = data.get('user_id')
+        user_id = self.resolve_user_id(data.get('user_id'))
         filename = data.get('filename') # Just the name, e.g., "book.txt"
         file_content_base64 = data.get('content') # Base64 encoded string
         author = data.get('author', 'Unknown')
@@ -259,33 +2041,22 @@ class MyHandler(http.server.SimpleHTTPRequestHandler):
             return
 
         try:
-            # Save file
-            safe_filename = f"{uuid.uuid4().hex}_{filename}" # Avoid collisions
-            file_path = os.path.join(BOOKS_DIR, safe_filename)
-            
-            # Decode base64
             # Handle data URL prefix if present (e.g., "data:text/plain;base64,....")
             if ',' in file_content_base64:
                 file_content_base64 = file_content_base64.split(',')[1]
                 
             file_bytes = base64.b64decode(file_content_base64)
-            
-            with open(file_path, 'wb') as f:
+
+            # Keep the raw bytes and let an ingest job do the rest; the client polls /api/jobs/<id>
+            os.makedirs(INCOMING_DIR, exist_ok=True)
+            raw_file = f"{uuid.uuid4().hex}.raw"
+            with open(os.path.join(INCOMING_DIR, raw_file), 'wb') as f:
                 f.write(file_bytes)
+            job_id = enqueue_job("ingest_book", {"user_id": user_id, "filename": filename, "author": author,
+                                                 "raw_file": raw_file},
+                                 user_id=user_id, priority=JOB_PRIORITY_INGEST)
             
-            # DB Insert
-            conn = sqlite3.connect(DB_FILE)
-            cursor = conn.cursor()
-            book_id = str(uuid.uuid4())
-            # Simplified title from filename
-            title = os.path.splitext(filename)[0]
-            
-            cursor.execute("INSERT INTO books (id, user_id, title, author, filepath) VALUES (?, ?, ?, ?, ?)",
-                           (book_id, user_id, title, author, safe_filename))
-            conn.commit()
-            conn.close()
-            
-            self.send_json_response(200, {"message": "Upload successful", "book_id": book_id})
+            self.send_json_response(202, {"message": "Upload queued", "job_id": job_id})
             
         except Exception as e:
             print(f"Upload Error: {e}")
@@ -301,7 +2072,7 @@ class MyHandler(http.server.SimpleHTTPRequestHandler):
                     k, v = p.split('=')
                     params[k] = v
         
-        user_id = params.get('user_id')
+        user_id = self.resolve_user_id(params.get('user_id'))
         if not user_id:
             self.send_json_response(400, {"error": "Missing user_id"})
             return
@@ -340,14 +2111,23 @@ class MyHandler(http.server.SimpleHTTPRequestHandler):
             return
             
         filepath, title, author = row
-        full_path = os.path.join(BOOKS_DIR, filepath)
         
         try:
-            with open(full_path, 'r', encoding='utf-8') as f:
-                content = f.read()
+            # The content hash is the ETag: a client holding this book gets a bodiless 304
+            ensure_utf8_blob(filepath)
+            etag = f'"{blob_hash(filepath)}"'
+            cache_headers = {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                for name, value in cache_headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                return
+            content = read_book_text(filepath)
             # Simple chunking could happen here, but sending full text for now (assuming < 2MB txt)
-            self.send_json_response(200, {"title": title, "author": author, "content": content})
+            self.send_json_response(200, {"title": title, "author": author, "content": content}, headers=cache_headers)
         except Exception as e:
+            print(f"Book Read Error: {e}")
             self.send_json_response(500, {"error": "Could not read book file"})
 
     def handle_get_current_book(self, query):
@@ -358,7 +2138,7 @@ class MyHandler(http.server.SimpleHTTPRequestHandler):
                     k, v = p.split('=')
                     params[k] = v
         
-        user_id = params.get('user_id')
+        user_id = self.resolve_user_id(params.get('user_id'))
         if not user_id:
             self.send_json_response(400, {"error": "Missing user_id"})
             return
@@ -390,7 +2170,7 @@ class MyHandler(http.server.SimpleHTTPRequestHandler):
             self.send_json_response(200, {"book_id": None})
 
     def handle_update_current_book(self, data):
-        user_id = data.get('user_id')
+        user_id = self.resolve_user_id(data.get('user_id'))
         book_id = data.get('book_id')
         
         if not user_id or not book_id:
@@ -402,12 +2182,31 @@ class MyHandler(http.server.SimpleHTTPRequestHandler):
         try:
             c.execute("UPDATE users SET current_book_id=? WHERE id=?", (book_id, user_id))
             conn.commit()
+            bootstrap_cache.discard(user_id)
             self.send_json_response(200, {"success": True})
         except Exception as e:
             self.send_json_response(500, {"error": str(e)})
         finally:
             conn.close()
 
+    def handle_update_progress(self, data):
+        user_id = self.resolve_user_id(None)
+        book_id = data.get('book_id')
+        progress = data.get('progress')
+        page = data.get('page')
+        if not book_id:
+            self.send_json_response(400, {"error": "Missing book_id"})
+            return
+        if not isinstance(progress, int) or not isinstance(page, int) or not 0 <= progress <= 100 or page < 0:
+            self.send_json_response(400, {"error": "Invalid progress"})
+            return
+
+        if not record_progress(user_id, book_id, progress, page):
+            self.send_json_response(404, {"error": "Book not found"})
+            return
+        bootstrap_cache.discard(user_id)
+        self.send_json_response(200, {"success": True})
+
     def handle_get_user_profile(self, query):
         params = {}
         if query:
@@ -416,9 +2215,23 @@ class MyHandler(http.server.SimpleHTTPRequestHandler):
                     k, v = p.split('=')
                     params[k] = v
         
-        user_id = params.get('user_id')
-        if not user_id:
-            self.send_json_response(400, {"error": "Missing user_id"})
+        user_id = self.resolve_user_id(params.get('user_id'))
+
+        # Session hit: the profile fields travel with the cached session, the
+        # reading stats are one user_stats row
+        session = self.get_session()
+        if session:
+            conn = sqlite3.connect(DB_FILE)
+            try:
+                stats = get_user_stats(conn.cursor(), session['user_id'])
+            finally:
+                conn.close()
+            self.send_json_response(200, {
+                "username": session['username'],
+                "avatar": session['avatar'] or "default_avatar_1.svg",
+                "signature": session['signature'] or "懂书也懂你",
+                "stats": stats
+            })
             return
 
         conn = sqlite3.connect(DB_FILE)
@@ -430,16 +2243,109 @@ class MyHandler(http.server.SimpleHTTPRequestHandler):
             self.send_json_response(200, {
                 "username": row[0],
                 "avatar": row[1] or "default_avatar_1.svg",
-                "signature": row[2] or "懂书也懂你"
+                "signature": row[2] or "懂书也懂你",
+                "stats": get_user_stats(c, user_id)
             })
         else:
             self.send_json_response(404, {"error": "User not found"})
         conn.close()
 
+    def handle_get_notes(self, query):
+        params = {}
+        if query:
+            for p in query.split('&'):
+                if '=' in p:
+                    k, v = p.split('=')
+                    params[k] = v
+
+        user_id = self.resolve_user_id(None)
+        book_id = params.get('book_id')
+        if not book_id:
+            self.send_json_response(400, {"error": "Missing book_id"})
+            return
+        try:
+            first = int(params.get('from', 0))
+            last = int(params.get('to', 2 ** 31))
+        except ValueError:
+            self.send_json_response(400, {"error": "Invalid paragraph range"})
+            return
+
+        conn = sqlite3.connect(DB_FILE)
+        c = conn.cursor()
+        try:
+            blob = user_book_blob(c, user_id, book_id)
+            if blob is None:
+                self.send_json_response(404, {"error": "Book not found"})
+                return
+            # [from, to) matches the reader's page slice of paragraphs
+            c.execute("SELECT " + ", ".join(NOTE_FIELDS) + " FROM notes WHERE user_id=? AND blob=? AND paragraph>=? AND paragraph<? AND deleted=0 ORDER BY paragraph, start_offset",
+                      (user_id, blob, first, last))
+            notes = [note_row_to_dict(r) for r in c.fetchall()]
+        finally:
+            conn.close()
+        self.send_json_response(200, {"notes": notes})
+
+    def handle_sync_notes(self, data):
+        user_id = self.resolve_user_id(None)
+        cursor = data.get('cursor', 0)
+        changes = data.get('changes', [])
+        if not isinstance(cursor, int) or not isinstance(changes, list):
+            self.send_json_response(400, {"error": "Invalid sync request"})
+            return
+        if len(changes) > NOTES_SYNC_MAX_CHANGES:
+            self.send_json_response(413, {"error": f"At most {NOTES_SYNC_MAX_CHANGES} changes per sync"})
+            return
+        parsed = [parse_note_change(change) for change in changes]
+        if any(change is None for change in parsed):
+            self.send_json_response(400, {"error": "Invalid note change"})
+            return
+
+        notes, new_cursor, has_more, reset = sync_notes(user_id, cursor, parsed)
+        self.send_json_response(200, {"changes": notes, "cursor": new_cursor, "has_more": has_more,
+                                      "reset": reset})
+
+    def handle_get_job(self, job_id):
+        # Endpoints newer than session tokens take no user_id fallback
+        user_id = self.resolve_user_id(None)
+        job = get_job(job_id)
+        # Only the uploader may see a job; others get the same 404 as for a missing id
+        if not job or job.pop("user_id") != user_id:
+            self.send_json_response(404, {"error": "Job not found"})
+            return
+        if job["status"] == 'done' and job["kind"] == 'ingest_book':
+            # The job may have run in another process; make sure this one's shelf is fresh
+            bootstrap_cache.discard(user_id)
+        self.send_json_response(200, job)
+
+    def handle_get_soulmates(self):
+        self.send_json_response(200, get_soulmates(self.resolve_user_id(None)))
+
+    def handle_bootstrap(self):
+        user_id = self.resolve_user_id(None)
+        payload = bootstrap_cache.get(user_id)
+        if payload is None:
+            payload = build_bootstrap(user_id)
+            if payload is None:
+                self.send_json_response(404, {"error": "User not found"})
+                return
+            bootstrap_cache.put(user_id, payload)
+        self.send_json_response(200, payload)
+
     def handle_chat(self, data):
         message = data.get('message', '')
-        user_id = data.get('user_id') 
+        user_id = self.resolve_user_id(data.get('user_id'), required=False)
         current_book_content = data.get('book_context', '') # Context from frontend
+        book_id = data.get('book_id')
+
+        # Only a session identifies a user; a user_id in the body is the
+        # caller's claim, so without a session the bucket is the client address
+        session = self.get_session()
+        user_key = f"user:{session['user_id']}" if session else f"ip:{self.client_ip()}"
+        retry_after = chat_scheduler.take_token(user_key)
+        if retry_after:
+            self.send_json_response(429, {"error": "Too many messages, please slow down"},
+                                    headers={'Retry-After': str(retry_after)})
+            return
         
         # Build context-aware prompt using the global configuration
         # Make a copy to avoid appending to the global constant forever
@@ -457,54 +2363,79 @@ class MyHandler(http.server.SimpleHTTPRequestHandler):
                 book_list = ", ".join([f"《{b[0]}》({b[1]})" for b in books])
                 system_prompt += f"\n\n你的用户目前藏书有：{book_list}。请在回答中适时关联这些书的内容，分析用户的阅读口味。"
 
-        # 2. Add Current Book Context
+        # 2. Add the precomputed book summary, which lets us send a much shorter excerpt
+        book_summary = get_book_summary(book_id) if book_id else None
+        if book_summary:
+            system_prompt += f"\n\n用户正在读的这本书的全书梗概：\n{book_summary}"
+
+        # 3. Add Current Book Context
         if current_book_content:
             # Truncate context if too long
-            context_snippet = current_book_content[:5000] 
+            context_snippet = current_book_content[:SUMMARY_EXCERPT_CHARS if book_summary else 5000] 
             system_prompt += f"\n\n用户正在阅读以下内容（节选）：\n{context_snippet}\n\n请结合这段内容回答用户的问题，如果用户问的是书里的人或事，请根据这段内容进行分析。如果用户在闲聊，也尽量关联到这段内容所体现的主题。"
         else:
              system_prompt += "结合用户提到的书本内容进行回应。"
 
-        ai_response = self.call_qwen(message, system_prompt)
+        try:
+            ai_response = self.call_qwen(message, system_prompt, user_key)
+        except AdmissionRejected as e:
+            self.send_json_response(429, {"error": e.reason}, headers={'Retry-After': str(e.retry_after)})
+            return
         self.send_json_response(200, {"response": ai_response})
 
-    def call_qwen(self, prompt, system_instruction):
-        # Use Qwen via DashScope compatible API
-        # Endpoint for Qwen-Turbo (Flash equivalent)
-        url = "https://dashscope.aliyuncs.com/compatible-mode/v1/chat/completions"
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {DASHSCOPE_API_KEY}'
-        }
-        
-        # User requested "qwen-flash-character" explicitly for free tier.
-        payload = {
-            "model": "qwen-flash-character", 
-            "messages": [
-                {"role": "system", "content": system_instruction},
-                {"role": "user", "content": prompt}
-            ]
-        }
+    def call_qwen(self, prompt, system_instruction, user_key=None):
+        # Identical payloads already in flight (e.g. a class asking the same quick
+        # question about the same default book) share one upstream request.
+        body = build_qwen_body(prompt, system_instruction)
+        key = hashlib.sha256(body).hexdigest()
+        # Only the request that actually goes upstream needs a concurrency slot;
+        # a leader refused admission doesn't refuse its followers, who retry under their own key.
+        return upstream_flights.do(key, lambda: self.post_qwen_admitted(body, user_key),
+                                   own_errors=(AdmissionRejected,))
 
+    def post_qwen_admitted(self, body, user_key):
+        chat_scheduler.acquire(user_key)
         try:
-            req = urllib.request.Request(url, data=json.dumps(payload).encode('utf-8'), headers=headers)
-            with urllib.request.urlopen(req, timeout=30) as response:
-                result = json.loads(response.read().decode('utf-8'))
-                try:
-                    return result['choices'][0]['message']['content']
-                except:
-                    return "我似乎走神了（API返回结构异常）"
+            return self.post_qwen(body)
+        finally:
+            chat_scheduler.release()
+
+    def post_qwen(self, body):
+        try:
+            return request_qwen(body)
         except urllib.error.HTTPError as e:
             return f"AI服务异常: {e.code} - {e.reason}"
+        except (KeyError, IndexError, TypeError):
+            return "我似乎走神了（API返回结构异常）"
         except Exception as e:
             return f"连接中断: {str(e)}"
 
-    def send_json_response(self, status_code, data):
+    def send_json_response(self, status_code, data, headers=None):
+        body = json.dumps(data).encode('utf-8')
         self.send_response(status_code)
         self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
         self.send_header('Access-Control-Allow-Origin', '*')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
         self.end_headers()
-        self.wfile.write(json.dumps(data).encode('utf-8'))
+        self.wfile.write(body)
+
+    def serve_service_worker(self):
+        try:
+            with open(SERVICE_WORKER_FILE, 'r', encoding='utf-8') as f:
+                script = f.read()
+        except OSError as e:
+            self.send_error(500, str(e))
+            return
+        body = script.replace('__ASSET_VERSION__', asset_manifest()["version"]).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/javascript')
+        self.send_header('Content-Length', str(len(body)))
+        # Browsers must see a new version as soon as it is deployed
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
 
     def serve_file(self, filename):
         if os.path.exists(filename):
@@ -517,6 +2448,7 @@ class MyHandler(http.server.SimpleHTTPRequestHandler):
                 self.send_response(200)
                 ctype, _ = mimetypes.guess_type(filename)
                 self.send_header('Content-Type', ctype or 'application/octet-stream')
+                self.send_header('Content-Length', str(len(content)))
                 self.end_headers()
                 self.wfile.write(content)
             except Exception as e:
@@ -528,10 +2460,261 @@ class ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
     daemon_threads = True
     allow_reuse_address = True
 
+# --- Prefork Serving ---
+# The master binds the socket and runs the migrations, then
+# forks workers that all accept() on the inherited fd, plus one process per
+# background job (job workers, summaries, soulmates, backups). The master only supervises: it
+# respawns processes that die and drains them on SIGTERM/SIGINT. SIGHUP
+# re-execs the master in place (same pid) with the listening socket passed
+# down in LISTEN_FD, so the new code and files are loaded from scratch; the
+# new master starts its workers, then drains the old ones (DRAIN_WORKERS),
+# which are still its children. The environment carries over unchanged.
+
+def reexec_master(httpd, workers):
+    fd = httpd.socket.fileno()
+    os.set_inheritable(fd, True)
+    os.environ["LISTEN_FD"] = str(fd)
+    os.environ["DRAIN_WORKERS"] = ",".join(str(pid) for pid in workers)
+    sys.stdout.flush()
+    os.execv(sys.executable, [sys.executable] + sys.argv)
+
+def run_worker(httpd):
+    # Let the master decide when we stop; Ctrl-C reaches the whole process group
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    # shutdown() blocks until serve_forever returns, so it can't run in the handler's thread
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=httpd.shutdown).start())
+    # Track request threads so server_close() waits for in-flight requests
+    httpd.daemon_threads = False
+    try:
+        httpd.serve_forever()
+    finally:
+        httpd.server_close()
+
+def run_background(job):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    # Stop with a parent that was killed outright instead of running on as an orphan
+    parent = os.getppid()
+    def watch_parent():
+        while not stop_event.wait(5):
+            if os.getppid() != parent:
+                stop_event.set()
+    threading.Thread(target=watch_parent, daemon=True).start()
+    job(stop_event)
+
+# Background jobs that are CPU-bound in Python. Without prefork they still
+# get a process of their own: spawned rather than forked, since request
+# threads are already running, and restarted if it dies.
+CHILD_PROCESS_JOBS = (run_soulmate_loop,)
+
+def run_in_child(job):
+    context = multiprocessing.get_context("spawn")
+    while True:
+        proc = context.Process(target=run_background, args=(job,), daemon=True)
+        proc.start()
+        proc.join()
+        # 0: stopped on purpose (SIGTERM on shutdown)
+        if proc.exitcode == 0:
+            return
+        print(f"Background {job.__name__} exited (status {proc.exitcode}), restarting")
+        time.sleep(5)
+
+def spawn_worker(target, arg):
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            target(arg)
+        except BaseException:
+            code = 1
+        os._exit(code)
+    return pid
+
+def stop_workers(pids):
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    deadline = time.time() + GRACEFUL_TIMEOUT
+    remaining = set(pids)
+    while remaining and time.time() < deadline:
+        for pid in list(remaining):
+            try:
+                done, _ = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                done = pid
+            if done:
+                remaining.discard(pid)
+        time.sleep(0.1)
+    for pid in remaining:
+        try:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        except (ProcessLookupError, ChildProcessError):
+            pass
+
+def serve_prefork(httpd, num_workers, background_jobs=()):
+    # Workers race for accept(); a non-blocking socket lets the losers go back to select()
+    httpd.socket.setblocking(False)
+
+    state = {"reload": False, "stop": False}
+    signal.signal(signal.SIGHUP, lambda signum, frame: state.update(reload=True))
+    signal.signal(signal.SIGTERM, lambda signum, frame: state.update(stop=True))
+    signal.signal(signal.SIGINT, lambda signum, frame: state.update(stop=True))
+
+    # One slot per process we keep alive; workers maps pid -> slot
+    slots = [(run_worker, httpd)] * num_workers + [(run_background, job) for job in background_jobs]
+    workers = {}
+    # Workers of the master we were exec'd from, drained once ours run
+    draining = [int(pid) for pid in os.environ.pop("DRAIN_WORKERS", "").split(",") if pid]
+    while not state["stop"]:
+        if state["reload"]:
+            state["reload"] = False
+            print("SIGHUP received, re-executing master...")
+            try:
+                reexec_master(httpd, workers)
+            except OSError as e:
+                print(f"Reload Error: {e}")
+
+        for i in set(range(len(slots))) - set(workers.values()):
+            pid = spawn_worker(*slots[i])
+            workers[pid] = i
+            print(f"Worker {pid} started")
+
+        if draining:
+            # New workers are already accepting while the old ones drain
+            stop_workers(draining)
+            print(f"Drained {len(draining)} workers of the previous master")
+            draining = []
+
+        # Reap any worker that died on its own; the loop above respawns it
+        while workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            if pid in workers:
+                del workers[pid]
+                print(f"Worker {pid} exited unexpectedly (status {status}), restarting")
+
+        time.sleep(0.5)
+
+    print("Shutting down workers...")
+    stop_workers(list(workers))
+
+def prepare_db(background_jobs):
+    try:
+        migrate_db()
+    except Exception as e:
+        # Exit so the platform's restart policy kicks in instead of serving 503s forever
+        print(f"Migration Error: {e}")
+        os._exit(1)
+    db_ready.set()
+    for job in background_jobs:
+        if job in CHILD_PROCESS_JOBS:
+            threading.Thread(target=run_in_child, args=(job,), daemon=True).start()
+        else:
+            threading.Thread(target=job, args=(threading.Event(),), daemon=True).start()
+
 if __name__ == "__main__":
+    # Apply pending migrations and exit: python run_app.py migrate
+    if sys.argv[1:2] == ["migrate"]:
+        migrate_db()
+        sys.exit(0)
+
+    # One-off summary pass: python run_app.py summarize
+    # Queues the missing summaries, then works the queue until nothing is due
+    if sys.argv[1:2] == ["summarize"]:
+        if not DASHSCOPE_API_KEY:
+            print("Summary Error: DASHSCOPE_API_KEY is not set")
+            sys.exit(1)
+        migrate_db()
+        print(f"Queued {queue_book_summaries()} book summaries")
+        worker_id = f"{os.getpid()}-summarize"
+        while (job := claim_job(worker_id)) is not None:
+            run_job(job, worker_id)
+        sys.exit(0)
+
+    # One-off soulmate pass: python run_app.py soulmates
+    if sys.argv[1:2] == ["soulmates"]:
+        migrate_db()
+        compute_soulmates()
+        sys.exit(0)
+
+    # Job workers only, next to a server started with JOB_WORKERS=0: python run_app.py jobs
+    if sys.argv[1:2] == ["jobs"]:
+        migrate_db()
+        stop_event = threading.Event()
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+        signal.signal(signal.SIGINT, lambda signum, frame: stop_event.set())
+        print(f"Running {max(JOB_WORKERS, 1)} job workers...")
+        run_job_workers(stop_event)
+        sys.exit(0)
+
+    # Compare user_stats with a full recomputation: python run_app.py stats [check|rebuild]
+    if sys.argv[1:2] == ["stats"]:
+        migrate_db()
+        conn = sqlite3.connect(DB_FILE, timeout=30)
+        conn.isolation_level = None
+        try:
+            if sys.argv[2:3] == ["rebuild"]:
+                # Write lock held throughout, so no trigger update lands between read and replace
+                conn.execute("BEGIN IMMEDIATE")
+                count = rebuild_user_stats(conn.cursor())
+                conn.execute("COMMIT")
+                print(f"Rebuilt reading stats for {count} users")
+                sys.exit(0)
+            # One read snapshot, so concurrent writes can't show up as drift
+            conn.execute("BEGIN")
+            mismatches = check_user_stats(conn.cursor())
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+        for user_id, expected, stored in mismatches:
+            print(f"{user_id}: expected {dict(zip(USER_STATS_FIELDS, expected))}, stored {dict(zip(USER_STATS_FIELDS, stored))}")
+        print(f"{len(mismatches)} users with drifted reading stats")
+        sys.exit(1 if mismatches else 0)
+
+    # Online backup of the database and book store: python run_app.py backup
+    if sys.argv[1:2] == ["backup"]:
+        manifest = create_backup(DB_FILE, BOOKS_DIR)
+        print(f"Backup {manifest['name']}: {len(manifest['blobs'])} blobs, {manifest['blobs_copied']} new")
+        sys.exit(0)
+
+    if BOOK_SUMMARIES and not DASHSCOPE_API_KEY:
+        print("DASHSCOPE_API_KEY is not set, book summaries are off")
+    background_jobs = [run_summary_loop] if BOOK_SUMMARIES and DASHSCOPE_API_KEY else []
+    if JOB_WORKERS > 0:
+        background_jobs.append(run_job_workers)
+    if BACKUP_INTERVAL > 0:
+        background_jobs.append(run_backup_loop)
+    if SOULMATES:
+        background_jobs.append(run_soulmate_loop)
+    prefork = WORKERS > 1 and hasattr(os, "fork")
+    # Set by reexec_master: keep serving on the socket the previous master bound
+    listen_fd = os.environ.pop("LISTEN_FD", None)
     print(f"Starting server on port {PORT}...")
-    with ThreadingTCPServer(("0.0.0.0", PORT), MyHandler) as httpd:
+    with ThreadingTCPServer(("0.0.0.0", PORT), MyHandler, bind_and_activate=listen_fd is None) as httpd:
+        if listen_fd is not None:
+            httpd.socket.close()
+            httpd.socket = socket.socket(fileno=int(listen_fd))
         try:
-            httpd.serve_forever()
+            if prefork:
+                # Migrate once in the master so workers are forked ready
+                migrate_db()
+                db_ready.set()
+                print(f"Prefork mode with {WORKERS} workers")
+                serve_prefork(httpd, WORKERS, background_jobs)
+            else:
+                # Serve right away; /healthz turns ready once migrations finish
+                threading.Thread(target=prepare_db, args=(background_jobs,), daemon=True).start()
+                httpd.serve_forever()
         except KeyboardInterrupt:
             pass
@@ -0,0 +1,4 @@
+// Session token for the API calls of every page. The token identifies the
+// user, so pages don't send a user_id. Load it before the page's own script.
+const sessionToken = localStorage.getItem('session_token');
+const authHeaders = sessionToken ? { 'Authorization': `Bearer ${sessionToken}` } : {};
@@ -0,0 +1,4 @@
+// Offline cache for pages, static assets and opened books (see /sw.js)
+if ('serviceWorker' in navigator) {
+    navigator.serviceWorker.register('/sw.js');
+}
@@ -0,0 +1,113 @@
+// Service worker for 会意. Served by run_app.py at /sw.js with the asset
+// version filled in, so any change to a page or static file gives this
+// script new bytes and the browser installs a fresh precache.
+const ASSET_VERSION = '__ASSET_VERSION__';
+const ASSET_CACHE = `huiyi-assets-${ASSET_VERSION}`;
+const BOOK_CACHE = 'huiyi-books';
+const FONT_CACHE = 'huiyi-fonts';
+const FONT_HOSTS = ['fonts.googleapis.com', 'fonts.gstatic.com', 'fonts.loli.net', 'gstatic.loli.net'];
+
+// Precache every page and static file listed in the manifest
+self.addEventListener('install', event => {
+    event.waitUntil((async () => {
+        const res = await fetch('/asset-manifest.json', { cache: 'no-store' });
+        const manifest = await res.json();
+        const cache = await caches.open(ASSET_CACHE);
+        await cache.addAll(Object.keys(manifest.assets).map(url => new Request(url, { cache: 'reload' })));
+        await self.skipWaiting();
+    })());
+});
+
+// Drop the caches of older asset versions
+self.addEventListener('activate', event => {
+    event.waitUntil((async () => {
+        const keys = await caches.keys();
+        await Promise.all(keys
+            .filter(key => key.startsWith('huiyi-assets-') && key !== ASSET_CACHE)
+            .map(key => caches.delete(key)));
+        await self.clients.claim();
+    })());
+});
+
+self.addEventListener('fetch', event => {
+    const request = event.request;
+    const url = new URL(request.url);
+
+    if (url.origin !== self.location.origin) {
+        if (request.method === 'GET' && FONT_HOSTS.includes(url.hostname)) {
+            event.respondWith(cacheFirst(FONT_CACHE, request));
+        }
+        return;
+    }
+
+    // Books belong to whoever is logged in on this device
+    if (url.pathname === '/api/logout') {
+        event.waitUntil(caches.delete(BOOK_CACHE));
+        return;
+    }
+
+    if (request.method !== 'GET') {
+        return;
+    }
+
+    if (url.pathname === '/api/book_content') {
+        event.respondWith(bookContent(event, request));
+        return;
+    }
+
+    if (url.pathname.startsWith('/api/') || url.pathname === '/sw.js' || url.pathname === '/asset-manifest.json') {
+        return;
+    }
+
+    // Pages ignore the query string (/reader?book_id=...), static files are cached as-is
+    event.respondWith((async () => {
+        const cache = await caches.open(ASSET_CACHE);
+        const cached = await cache.match(request, { ignoreSearch: request.mode === 'navigate' });
+        if (cached) {
+            return cached;
+        }
+        const res = await fetch(request);
+        // Font slices under /static/fonts/ are content-addressed and loaded on demand
+        if (res.ok && url.pathname.startsWith('/static/fonts/')) {
+            await cache.put(request, res.clone());
+        }
+        return res;
+    })());
+});
+
+async function cacheFirst(cacheName, request) {
+    const cache = await caches.open(cacheName);
+    const cached = await cache.match(request);
+    if (cached) {
+        return cached;
+    }
+    const res = await fetch(request);
+    if (res.ok || res.type === 'opaque') {
+        await cache.put(request, res.clone());
+    }
+    return res;
+}
+
+// Reopening a book is served from the cache at once, then revalidated
+// against its content hash (ETag); only a changed book is downloaded again.
+async function bookContent(event, request) {
+    const cache = await caches.open(BOOK_CACHE);
+    const cached = await cache.match(request);
+
+    const headers = new Headers(request.headers);
+    if (cached && cached.headers.get('ETag')) {
+        headers.set('If-None-Match', cached.headers.get('ETag'));
+    }
+    const revalidate = fetch(request.url, { headers, cache: 'no-store' }).then(async res => {
+        if (res.status === 200) {
+            await cache.put(request, res.clone());
+        }
+        return res;
+    });
+
+    if (cached) {
+        event.waitUntil(revalidate.catch(() => {}));
+        return cached;
+    }
+    return revalidate;
+}
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+# Reading-taste similarity for the profile page's 书友匹配.
+# Every user is a sparse row over the books on their shelf, weighted by how
+# rare the book is (IDF) and how far they read it; neighbours are ranked by
+# cosine similarity. The matrix is kept in flat CSR arrays (user -> books)
+# plus the transposed CSC arrays (book -> readers), so a million users fit in
+# a few hundred MB without NumPy. A user's row is multiplied against the
+# columns of their books (the readers of each book, capped per book), which
+# gives partial dot products for every candidate; only the best of those are
+# rescored exactly. A pass costs O(users x shelf size x MAX_BOOK_READERS)
+# instead of O(users^2).
+import heapq
+import math
+import re
+from array import array
+
+MAX_BOOK_READERS = 200   # readers of one book considered as candidates per user
+MAX_SHARED_TITLES = 3    # shared books listed with each match
+RESCORE_FACTOR = 3       # candidates rescored exactly per requested neighbour
+
+TITLE_NOISE_RE = re.compile(r'[\s《》「」【】\[\]()（）_\-·.,，。:：!！?？]+')
+
+
+def normalize_title(title):
+    """Key used to treat uploads of the same book by different users as one book."""
+    return TITLE_NOISE_RE.sub('', title or '').lower()
+
+
+class TasteIndex:
+    """Sparse user x book matrix built from (user_id, title, progress) rows.
+
+    Rows must be grouped by user_id (e.g. ORDER BY user_id).
+    """
+
+    def __init__(self, rows, max_book_readers=MAX_BOOK_READERS):
+        self.max_book_readers = max_book_readers
+        self.user_ids = []
+        self.titles = []
+        book_keys = {}
+
+        # CSR: books of user u are cols[ptr[u]:ptr[u + 1]], progress in progress[...]
+        ptr = array('l', [0])
+        cols = array('l')
+        progress = array('h')
+        shelf = {}
+        last_user = None
+        for user_id, title, book_progress in rows:
+            key = normalize_title(title)
+            if not key:
+                continue
+            if user_id != last_user:
+                if last_user is not None:
+                    self._append_shelf(shelf, ptr, cols, progress)
+                self.user_ids.append(user_id)
+                last_user, shelf = user_id, {}
+            book = book_keys.get(key)
+            if book is None:
+                book = book_keys[key] = len(self.titles)
+                self.titles.append(title.strip())
+            pct = min(max(book_progress or 0, 0), 100)
+            shelf[book] = max(shelf.get(book, 0), pct)
+        if last_user is not None:
+            self._append_shelf(shelf, ptr, cols, progress)
+
+        users = len(self.user_ids)
+        books = len(self.titles)
+        readers = array('l', [0]) * books
+        for book in cols:
+            readers[book] += 1
+        # A book everyone (or no one else) has says nothing about taste
+        idf = [math.log(users / n) if 1 < n < users else 0.0 for n in readers]
+
+        vals = array('d', [idf[book] * (1 + pct / 100) for book, pct in zip(cols, progress)])
+        norms = array('d', [0.0]) * users
+        for u in range(users):
+            norms[u] = math.sqrt(sum(w * w for w in vals[ptr[u]:ptr[u + 1]]))
+
+        # CSC: readers of book b are reader_rows[reader_ptr[b]:reader_ptr[b + 1]]
+        # (weights in reader_vals), filled by counting sort
+        reader_ptr = array('l', [0]) * (books + 1)
+        for b in range(books):
+            reader_ptr[b + 1] = reader_ptr[b] + readers[b]
+        fill = array('l', reader_ptr[:books])
+        reader_rows = array('l', [0]) * len(cols)
+        reader_vals = array('d', [0.0]) * len(cols)
+        for u in range(users):
+            for j in range(ptr[u], ptr[u + 1]):
+                book = cols[j]
+                reader_rows[fill[book]] = u
+                reader_vals[fill[book]] = vals[j]
+                fill[book] += 1
+
+        self.ptr, self.cols, self.vals, self.norms = ptr, cols, vals, norms
+        self.reader_ptr, self.reader_rows, self.reader_vals = reader_ptr, reader_rows, reader_vals
+
+    @staticmethod
+    def _append_shelf(shelf, ptr, cols, progress):
+        for book in sorted(shelf):
+            cols.append(book)
+            progress.append(shelf[book])
+        ptr.append(len(cols))
+
+    @property
+    def user_count(self):
+        return len(self.user_ids)
+
+    def _row(self, u):
+        start, end = self.ptr[u], self.ptr[u + 1]
+        return {self.cols[j]: self.vals[j] for j in range(start, end) if self.vals[j] > 0}
+
+    def _readers(self, u, book):
+        start, end = self.reader_ptr[book], self.reader_ptr[book + 1]
+        cap = self.max_book_readers
+        if end - start <= cap:
+            return self.reader_rows[start:end], self.reader_vals[start:end]
+        # Popular book: a window of its readers that rotates with the user,
+        # so each reader still meets some of the others
+        offset = start + (u * cap) % (end - start)
+        rows = self.reader_rows[offset:end][:cap]
+        vals = self.reader_vals[offset:end][:cap]
+        rows += self.reader_rows[start:start + cap - len(rows)]
+        vals += self.reader_vals[start:start + cap - len(vals)]
+        return rows, vals
+
+    def _exact(self, row, v):
+        dot = 0.0
+        shared = []
+        for j in range(self.ptr[v], self.ptr[v + 1]):
+            w = row.get(self.cols[j])
+            if w:
+                product = w * self.vals[j]
+                dot += product
+                shared.append((product, self.cols[j]))
+        return dot, shared
+
+    def neighbours(self, u, k):
+        """Returns up to k (user_id, score, shared_titles) for user index u, best first."""
+        row = self._row(u)
+        if not row:
+            return []
+
+        # Sparse row x columns product; exact except for readers a popular
+        # book's window left out
+        partial = {}
+        get = partial.get
+        for book, w in row.items():
+            rows, vals = self._readers(u, book)
+            for v, x in zip(rows, vals):
+                partial[v] = get(v, 0.0) + w * x
+        partial.pop(u, None)
+
+        norms = self.norms
+        candidates = heapq.nlargest(k * RESCORE_FACTOR, partial.items(), key=lambda item: item[1] / norms[item[0]])
+        scored = []
+        for v, _ in candidates:
+            dot, shared = self._exact(row, v)
+            scored.append((dot / (norms[u] * norms[v]), v, shared))
+
+        best = heapq.nlargest(k, scored, key=lambda item: (item[0], -item[1]))
+        return [(self.user_ids[v], round(score, 4),
+                 [self.titles[book] for _, book in sorted(shared, reverse=True)[:MAX_SHARED_TITLES]])
+                for score, v, shared in best]
@@ -0,0 +1,83 @@
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import unittest
+import urllib.error
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import run_app
+
+# Data paths of run_app, relative to a test's temp dir
+APP_PATHS = {"DB_FILE": "mybook.db", "BOOKS_DIR": "books", "INCOMING_DIR": "incoming", "ORIGINALS_DIR": "originals"}
+
+
+class TempDirTestCase(unittest.TestCase):
+    """A fresh temp dir per test, and module attributes patched until the test ends."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def patch(self, obj, name, value):
+        saved = getattr(obj, name)
+        setattr(obj, name, value)
+        self.addCleanup(setattr, obj, name, saved)
+
+
+class AppTestCase(TempDirTestCase):
+    """run_app with its database and data directories in the temp dir, migrated."""
+
+    def setUp(self):
+        super().setUp()
+        for name, path in APP_PATHS.items():
+            self.patch(run_app, name, os.path.join(self.tmp, path))
+        os.makedirs(run_app.BOOKS_DIR)
+        os.makedirs(run_app.INCOMING_DIR)
+        run_app.migrate_db()
+
+    def execute(self, sql, *args):
+        conn = sqlite3.connect(run_app.DB_FILE)
+        try:
+            rows = conn.execute(sql, args).fetchall()
+            conn.commit()
+            return rows
+        finally:
+            conn.close()
+
+
+class ServerTestCase(AppTestCase):
+    """AppTestCase plus the HTTP handler serving on a free local port."""
+
+    def setUp(self):
+        super().setUp()
+        run_app.db_ready.set()
+        self.addCleanup(run_app.db_ready.clear)
+        httpd = run_app.ThreadingTCPServer(("127.0.0.1", 0), run_app.MyHandler)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        self.addCleanup(httpd.server_close)
+        self.addCleanup(httpd.shutdown)
+        self.base = f"http://127.0.0.1:{httpd.server_address[1]}"
+
+    def request(self, path, body=None, token=None):
+        """Returns (status, headers, JSON body); a body makes it a POST."""
+        headers = {"Content-Type": "application/json"}
+        if token:
+            headers["Authorization"] = f"Bearer {token}"
+        data = json.dumps(body).encode() if body is not None else None
+        req = urllib.request.Request(self.base + path, data=data, headers=headers)
+        try:
+            with urllib.request.urlopen(req, timeout=10) as res:
+                return res.status, dict(res.headers), json.load(res)
+        except urllib.error.HTTPError as e:
+            return e.code, dict(e.headers), json.load(e)
+
+    def login(self, username="test_user_1", password="123456"):
+        status, _, data = self.request("/api/login", {"username": username, "password": password})
+        self.assertEqual(status, 200)
+        return data["token"]
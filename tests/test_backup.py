@@ -0,0 +1,69 @@
+import multiprocessing
+import os
+import sqlite3
+import time
+import unittest
+
+from support import TempDirTestCase
+import backup
+
+
+def hold_lock(backup_dir, ready, seconds):
+    # Stands in for a backup in another process, halfway through copying a blob
+    with backup.backup_lock(backup_dir):
+        tmp_path = os.path.join(backup_dir, backup.BLOB_STORE, "book.txt.tmp")
+        with open(tmp_path, 'wb') as f:
+            f.write(b"half")
+        ready.set()
+        time.sleep(seconds)
+        os.remove(tmp_path)
+
+
+class BackupTest(TempDirTestCase):
+    """Backups of a small database and book store."""
+
+    def setUp(self):
+        super().setUp()
+        self.db = os.path.join(self.tmp, "mybook.db")
+        self.books = os.path.join(self.tmp, "books")
+        self.backups = os.path.join(self.tmp, "backups")
+        os.makedirs(self.books)
+        conn = sqlite3.connect(self.db)
+        conn.execute("CREATE TABLE books (id TEXT PRIMARY KEY, filepath TEXT)")
+        conn.execute("INSERT INTO books VALUES ('1', 'a.txt')")
+        conn.commit()
+        conn.close()
+        with open(os.path.join(self.books, "a.txt"), 'w', encoding='utf-8') as f:
+            f.write("第一章\n")
+
+    def test_restore_puts_back_database_and_blobs(self):
+        manifest = backup.create_backup(self.db, self.books, self.backups, keep=2)
+        os.remove(os.path.join(self.books, "a.txt"))
+        conn = sqlite3.connect(self.db)
+        conn.execute("DELETE FROM books")
+        conn.commit()
+        conn.close()
+
+        result = backup.restore_backup(manifest["name"], self.db, self.books, self.backups)
+        self.assertEqual(result["blobs_restored"], 1)
+        conn = sqlite3.connect(self.db)
+        self.assertEqual(conn.execute("SELECT filepath FROM books").fetchall(), [("a.txt",)])
+        conn.close()
+
+    def test_prune_waits_for_a_running_backup(self):
+        backup.create_backup(self.db, self.books, self.backups, keep=2)
+        ready = multiprocessing.Event()
+        holder = multiprocessing.Process(target=hold_lock, args=(self.backups, ready, 0.5))
+        holder.start()
+        self.assertTrue(ready.wait(10))
+
+        started = time.monotonic()
+        backup.prune_backups(self.backups, keep=2)
+        holder.join()
+        self.assertGreater(time.monotonic() - started, 0.3)
+        # The holder found its .tmp blob still there when it went to move it
+        self.assertEqual(holder.exitcode, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,212 @@
+import multiprocessing
+import threading
+import time
+import types
+import unittest
+
+from support import AppTestCase, ServerTestCase, run_app
+from fake_upstream import start_fake_upstream
+
+
+def make_scheduler(rate_per_min=60, burst=2, concurrency=1, queue_timeout=10, queue_max_per_user=3, shared_slots=None):
+    return run_app.ChatScheduler(rate_per_min, burst, concurrency, queue_timeout, queue_max_per_user,
+                                 shared_slots=shared_slots)
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("condition not met in time")
+        time.sleep(0.01)
+
+
+def call_upstream_twice(scheduler, prompt):
+    # One prefork worker: two chat requests at once through its own scheduler
+    def one():
+        scheduler.acquire("user:a")
+        try:
+            run_app.request_qwen(run_app.build_qwen_body(prompt, "system"))
+        finally:
+            scheduler.release()
+    threads = [threading.Thread(target=one) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+class ChatSchedulerTest(AppTestCase):
+    """Token buckets, fair queueing and the upstream slot cap."""
+
+    def setUp(self):
+        super().setUp()
+        self.now = 1000.0
+        self.patch(run_app, "time", types.SimpleNamespace(**{**vars(time), "monotonic": lambda: self.now}))
+
+    def test_bucket_refills_at_the_configured_rate(self):
+        scheduler = make_scheduler(rate_per_min=60, burst=2)
+        self.assertEqual(scheduler.take_token("user:a"), 0)
+        self.assertEqual(scheduler.take_token("user:a"), 0)
+        self.assertEqual(scheduler.take_token("user:a"), 1)
+        # Another user has a bucket of their own
+        self.assertEqual(scheduler.take_token("user:b"), 0)
+
+        self.now += 1
+        self.assertEqual(scheduler.take_token("user:a"), 0)
+        self.assertEqual(scheduler.take_token("user:a"), 1)
+        # Never more than the burst, however long the pause
+        self.now += 3600
+        self.assertEqual([scheduler.take_token("user:a") for _ in range(3)], [0, 0, 1])
+        self.assertEqual(scheduler.snapshot()["rejected_rate"], 3)
+
+    def test_freed_slots_rotate_between_users(self):
+        self.patch(run_app, "time", time)
+        scheduler = make_scheduler(concurrency=1)
+        scheduler.acquire("user:holder")
+        order = []
+
+        def chat(user):
+            scheduler.acquire(user)
+            order.append(user)
+            scheduler.release()
+
+        threads = []
+        for user in ["user:a", "user:a", "user:a", "user:b"]:
+            threads.append(threading.Thread(target=chat, args=(user,)))
+            threads[-1].start()
+            wait_until(lambda: scheduler.snapshot()["waiting"] == len(threads))
+        scheduler.release()
+        for thread in threads:
+            thread.join()
+        # b queued last but is served second, not behind all of a's requests
+        self.assertEqual(order, ["user:a", "user:b", "user:a", "user:a"])
+
+    def test_queue_limits_reject_with_a_retry_hint(self):
+        self.patch(run_app, "time", time)
+        scheduler = make_scheduler(concurrency=1, queue_timeout=0.2, queue_max_per_user=1)
+        scheduler.acquire("user:a")
+        with self.assertRaises(run_app.AdmissionRejected) as timed_out:
+            scheduler.acquire("user:b")
+        self.assertEqual(timed_out.exception.reason, "Server busy")
+        self.assertGreaterEqual(timed_out.exception.retry_after, 1)
+
+        waiter = threading.Thread(target=lambda: self.assertRaises(run_app.AdmissionRejected,
+                                                                   scheduler.acquire, "user:b"))
+        waiter.start()
+        wait_until(lambda: scheduler.snapshot()["waiting"] == 1)
+        with self.assertRaises(run_app.AdmissionRejected) as too_many:
+            scheduler.acquire("user:b")
+        self.assertEqual(too_many.exception.reason, "Too many pending requests")
+        waiter.join()
+
+    def test_shared_slots_cap_upstream_calls_across_processes(self):
+        self.patch(run_app, "time", time)
+        upstream, url = start_fake_upstream(delay=0.2)
+        self.addCleanup(upstream.server_close)
+        self.addCleanup(upstream.shutdown)
+        self.patch(run_app, "DASHSCOPE_API_URL", url)
+
+        # Two workers that would each allow two calls, sharing one global slot
+        shared = run_app.make_upstream_slots(1)
+        context = multiprocessing.get_context("fork")
+        workers = [context.Process(target=call_upstream_twice, args=(make_scheduler(concurrency=2, shared_slots=shared),
+                                                                     f"worker {i}"))
+                   for i in range(2)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(30)
+        self.assertEqual([worker.exitcode for worker in workers], [0, 0])
+        self.assertEqual(upstream.stats["calls"], 4)
+        self.assertEqual(upstream.stats["max_active"], 1)
+
+
+class SingleFlightTest(unittest.TestCase):
+    """Coalescing of identical upstream calls."""
+
+    def test_followers_share_the_leaders_result(self):
+        flights = run_app.SingleFlight()
+        release = threading.Event()
+        results = []
+
+        def leader():
+            release.wait(5)
+            return "reply"
+
+        first = threading.Thread(target=lambda: results.append(flights.do("k", leader)))
+        first.start()
+        wait_until(lambda: "k" in flights._calls)
+        second = threading.Thread(target=lambda: results.append(flights.do("k", lambda: "own call")))
+        second.start()
+        time.sleep(0.05)
+        release.set()
+        first.join()
+        second.join()
+        self.assertEqual(results, ["reply", "reply"])
+
+    def test_followers_retry_when_the_leader_is_refused_admission(self):
+        flights = run_app.SingleFlight()
+        release = threading.Event()
+        outcomes = []
+
+        def refused():
+            release.wait(5)
+            raise run_app.AdmissionRejected("Too many pending requests", 3)
+
+        def leader():
+            try:
+                flights.do("k", refused, own_errors=(run_app.AdmissionRejected,))
+            except run_app.AdmissionRejected as e:
+                outcomes.append(("leader", e.reason))
+
+        def follower():
+            outcomes.append(("follower", flights.do("k", lambda: "reply", own_errors=(run_app.AdmissionRejected,))))
+
+        first = threading.Thread(target=leader)
+        first.start()
+        wait_until(lambda: "k" in flights._calls)
+        second = threading.Thread(target=follower)
+        second.start()
+        time.sleep(0.05)
+        release.set()
+        first.join()
+        second.join()
+        self.assertCountEqual(outcomes, [("leader", "Too many pending requests"), ("follower", "reply")])
+
+
+class ChatEndpointTest(ServerTestCase):
+    """/api/chat and /api/chat_metrics over HTTP, against the fake upstream."""
+
+    def setUp(self):
+        super().setUp()
+        upstream, url = start_fake_upstream()
+        self.addCleanup(upstream.server_close)
+        self.addCleanup(upstream.shutdown)
+        self.patch(run_app, "DASHSCOPE_API_URL", url)
+        self.patch(run_app, "chat_scheduler", make_scheduler(rate_per_min=1, burst=2, concurrency=2))
+
+    def test_rate_limited_chat_gets_429_with_retry_after(self):
+        for _ in range(2):
+            status, _, data = self.request("/api/chat", {"message": "你好"})
+            self.assertEqual(status, 200)
+            self.assertTrue(data["response"].startswith("概要："))
+        status, headers, data = self.request("/api/chat", {"message": "你好"})
+        self.assertEqual(status, 429)
+        self.assertGreaterEqual(int(headers["Retry-After"]), 1)
+
+        # A logged-in user is limited by their session, not the shared address
+        token = self.login()
+        status, _, _ = self.request("/api/chat", {"message": "你好"}, token=token)
+        self.assertEqual(status, 200)
+
+    def test_chat_metrics_need_a_session(self):
+        status, _, _ = self.request("/api/chat_metrics")
+        self.assertEqual(status, 401)
+        status, _, data = self.request("/api/chat_metrics", token=self.login())
+        self.assertEqual(status, 200)
+        self.assertIn("waiting_users", data)
+
+
+if __name__ == "__main__":
+    unittest.main()
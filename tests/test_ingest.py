@@ -0,0 +1,43 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from book_ingest import normalize_book
+
+BODY = "".join(f"第{i}段，他走了很远的路。\n" for i in range(40))
+
+
+class AdStripTest(unittest.TestCase):
+    """Ad lines go, prose that merely shares a phrase with them stays."""
+
+    def clean(self, text, encoding='utf-8'):
+        normalized, info = normalize_book(text.encode(encoding))
+        return normalized.decode('utf-8'), info["removed_lines"]
+
+    def test_keeps_prose_with_one_phrase(self):
+        text = BODY + "更多精彩的故事还在后面呢。\n" + BODY
+        cleaned, removed = self.clean(text, 'gb18030')
+        self.assertIn("更多精彩的故事还在后面呢。", cleaned)
+        self.assertEqual(removed, 0)
+
+    def test_keeps_prose_with_a_url_in_the_body(self):
+        text = BODY + "他在纸上写下 www.example.com 就走了。\n" + BODY
+        self.assertEqual(self.clean(text)[1], 0)
+
+    def test_drops_url_and_phrase_anywhere(self):
+        text = BODY + "本书由某某小说网整理 www.xxx.com\n" + BODY
+        cleaned, removed = self.clean(text)
+        self.assertNotIn("www.xxx.com", cleaned)
+        self.assertEqual(removed, 1)
+
+    def test_drops_banners_at_the_edges(self):
+        text = "TXT下载 免费下载\n" + BODY + "http://www.xxx.net\n"
+        cleaned, removed = self.clean(text)
+        self.assertEqual(removed, 2)
+        self.assertTrue(cleaned.startswith("第0段"))
+
+
+if __name__ == "__main__":
+    unittest.main()
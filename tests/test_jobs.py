@@ -0,0 +1,77 @@
+import os
+import sqlite3
+import threading
+import time
+import unittest
+
+from support import AppTestCase, run_app
+
+
+class JobQueueTest(AppTestCase):
+    """Lease expiry and clean-up of the persistent job queue."""
+
+    def expire_lease(self, job_id):
+        self.execute("UPDATE jobs SET locked_until=? WHERE id=?", time.time() - 1, job_id)
+
+    def test_expired_lease_requeues_until_out_of_attempts(self):
+        job_id = run_app.enqueue_job("ingest_book", {"raw_file": "a.raw"}, max_attempts=2)
+        self.assertEqual(run_app.claim_job("w").id, job_id)
+        self.expire_lease(job_id)
+        self.assertEqual(run_app.claim_job("w").id, job_id)
+        self.expire_lease(job_id)
+
+        # Both attempts died with their worker: the job fails instead of running again
+        self.assertIsNone(run_app.claim_job("w"))
+        self.assertEqual(self.execute("SELECT status, error FROM jobs"), [("failed", "Worker died mid-job")])
+
+    def test_stale_worker_cannot_overwrite_the_reclaiming_worker(self):
+        job_id = run_app.enqueue_job("ingest_book", {"raw_file": "a.raw"})
+        stale = run_app.claim_job("w1")
+        self.expire_lease(job_id)
+        fresh = run_app.claim_job("w2")
+
+        self.assertFalse(run_app.finish_job(stale, 'done', result={"blob": "stale"}))
+        with self.assertRaises(run_app.LeaseLost):
+            stale.save("transcode", 0.5)
+        self.assertEqual(self.execute("SELECT status, locked_by, result FROM jobs"), [("running", "w2", None)])
+        self.assertTrue(run_app.finish_job(fresh, 'done', result={"blob": "fresh"}))
+        self.assertEqual(self.execute("SELECT status, result FROM jobs"), [("done", '{"blob": "fresh"}')])
+
+    def test_worker_survives_a_locked_database_when_finishing(self):
+        stop_event = threading.Event()
+        finished = []
+        original = run_app.finish_job
+
+        def flaky_finish(job, status, **kwargs):
+            finished.append(job.id)
+            if len(finished) == 1:
+                raise sqlite3.OperationalError("database is locked")
+            stop_event.set()
+            return original(job, status, **kwargs)
+
+        self.patch(run_app, "finish_job", flaky_finish)
+        self.patch(run_app, "JOB_HANDLERS", {"noop": lambda job: {}})
+        first = run_app.enqueue_job("noop", {}, priority=1)
+        second = run_app.enqueue_job("noop", {})
+        run_app.run_job_worker(stop_event, "w")
+
+        self.assertEqual(finished, [first, second])
+        self.assertEqual(self.execute("SELECT status FROM jobs WHERE id=?", second), [("done",)])
+
+    def test_prune_removes_uploads_no_live_job_reads(self):
+        old = time.time() - run_app.JOB_LEASE - 1
+        for name in ("queued.raw", "failed.raw", "orphan.raw", "fresh.raw"):
+            with open(os.path.join(run_app.INCOMING_DIR, name), 'wb') as f:
+                f.write(b"x")
+            if name != "fresh.raw":
+                os.utime(os.path.join(run_app.INCOMING_DIR, name), (old, old))
+        run_app.enqueue_job("ingest_book", {"raw_file": "queued.raw"})
+        failed_id = run_app.enqueue_job("ingest_book", {"raw_file": "failed.raw"})
+        self.execute("UPDATE jobs SET status='failed' WHERE id=?", failed_id)
+
+        run_app.prune_jobs()
+        self.assertEqual(sorted(os.listdir(run_app.INCOMING_DIR)), ["fresh.raw", "queued.raw"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+import time
+import unittest
+
+from support import AppTestCase, ServerTestCase, run_app
+
+
+class NotesSyncTest(AppTestCase):
+    """Cursor sync of highlights between two devices of one user."""
+
+    def setUp(self):
+        super().setUp()
+        self.user_id, self.book_id = self.execute("SELECT user_id, id FROM books LIMIT 1")[0]
+
+    def change(self, note_id, updated_at, **fields):
+        change = {"id": note_id, "book_id": self.book_id, "paragraph": 3, "start_offset": 0,
+                  "end_offset": 4, "quote": "满纸荒唐", "note": None, "color": "yellow",
+                  "deleted": False, "updated_at": updated_at}
+        change.update(fields)
+        return change
+
+    def test_newer_edit_wins_and_the_loser_gets_the_server_copy(self):
+        now = time.time()
+        _, cursor, _, _ = run_app.sync_notes(self.user_id, 0, [self.change("n1", now, note="first")])
+        # Another device saw the note, then both edited it
+        run_app.sync_notes(self.user_id, cursor, [self.change("n1", now + 10, note="phone")])
+        notes, late_cursor, _, _ = run_app.sync_notes(self.user_id, cursor, [self.change("n1", now + 5, note="laptop")])
+
+        self.assertEqual([(note["id"], note["note"]) for note in notes], [("n1", "phone")])
+        self.assertEqual(self.execute("SELECT note FROM notes WHERE id='n1'"), [("phone",)])
+        # Caught up: nothing more to send this device
+        self.assertEqual(run_app.sync_notes(self.user_id, late_cursor, [])[0], [])
+
+    def test_deletes_sync_as_tombstones(self):
+        now = time.time()
+        _, cursor, _, _ = run_app.sync_notes(self.user_id, 0, [self.change("n1", now), self.change("n2", now)])
+        run_app.sync_notes(self.user_id, cursor, [self.change("n1", now + 1, deleted=True)])
+
+        notes, _, _, reset = run_app.sync_notes(self.user_id, cursor, [])
+        self.assertFalse(reset)
+        self.assertEqual([(note["id"], note["deleted"]) for note in notes], [("n1", True)])
+        self.assertEqual(self.execute("SELECT id FROM notes WHERE deleted=0"), [("n2",)])
+
+    def test_a_cursor_from_before_pruned_tombstones_is_reset(self):
+        old = time.time() - run_app.NOTES_TOMBSTONE_TTL - 60
+        _, stale_cursor, _, _ = run_app.sync_notes(self.user_id, 0, [self.change("n1", old), self.change("n2", old)])
+        _, cursor, _, _ = run_app.sync_notes(self.user_id, stale_cursor, [self.change("n1", old + 1, deleted=True)])
+        run_app.prune_note_tombstones()
+        self.assertEqual(self.execute("SELECT id FROM notes"), [("n2",)])
+
+        # The delete of n1 is gone, so this device must start over
+        notes, new_cursor, has_more, reset = run_app.sync_notes(self.user_id, stale_cursor, [])
+        self.assertTrue(reset)
+        self.assertFalse(has_more)
+        self.assertEqual([note["id"] for note in notes], ["n2"])
+        self.assertEqual(new_cursor, cursor)
+        # A device that already saw the delete carries on as usual
+        self.assertEqual(run_app.sync_notes(self.user_id, cursor, []), ([], cursor, False, False))
+
+    def test_pages_follow_the_cursor(self):
+        self.patch(run_app, "NOTES_SYNC_PAGE", 2)
+        now = time.time()
+        run_app.sync_notes(self.user_id, 0, [self.change(f"n{i}", now) for i in range(5)])
+        seen, cursor, has_more = [], 0, True
+        while has_more:
+            notes, cursor, has_more, _ = run_app.sync_notes(self.user_id, cursor, [])
+            seen += [note["id"] for note in notes]
+        self.assertEqual(seen, [f"n{i}" for i in range(5)])
+
+    def test_changes_to_other_users_books_are_ignored(self):
+        other_book = self.execute("SELECT id FROM books WHERE user_id<>? LIMIT 1", self.user_id)[0][0]
+        notes, cursor, _, _ = run_app.sync_notes(self.user_id, 0, [self.change("n1", time.time(), book_id=other_book)])
+        self.assertEqual((notes, cursor), ([], 0))
+        self.assertEqual(self.execute("SELECT COUNT(*) FROM notes"), [(0,)])
+
+
+class NotesEndpointTest(ServerTestCase):
+    """/api/notes/sync and the reader's per-page /api/notes."""
+
+    def test_page_fetch_returns_live_notes_in_the_range(self):
+        token = self.login()
+        book_id = self.execute("SELECT b.id FROM books b JOIN users u ON u.id=b.user_id WHERE u.username='test_user_1' LIMIT 1")[0][0]
+        changes = [{"id": f"n{p}", "book_id": book_id, "paragraph": p, "start_offset": 0, "end_offset": 2,
+                    "updated_at": 1} for p in (2, 8, 9)]
+        changes.append({"id": "n9", "book_id": book_id, "paragraph": 9, "deleted": True, "updated_at": 2})
+        status, _, data = self.request("/api/notes/sync", {"cursor": 0, "changes": changes[:3]}, token=token)
+        self.assertEqual(status, 200)
+        status, _, data = self.request("/api/notes/sync", {"cursor": data["cursor"], "changes": changes[3:]},
+                                       token=token)
+        self.assertEqual((status, data["changes"], data["reset"]), (200, [], False))
+
+        # Page two of eight paragraphs: 8 is on it, 2 isn't, 9 was deleted
+        status, _, data = self.request(f"/api/notes?book_id={book_id}&from=8&to=16", token=token)
+        self.assertEqual(status, 200)
+        self.assertEqual([note["id"] for note in data["notes"]], ["n8"])
+
+    def test_notes_need_a_session(self):
+        status, _, _ = self.request("/api/notes/sync", {"cursor": 0, "changes": []})
+        self.assertEqual(status, 401)
+        status, _, _ = self.request("/api/notes/sync", {"cursor": 0, "changes": [{"id": "n1"}]}, token=self.login())
+        self.assertEqual(status, 400)
+
+
+if __name__ == "__main__":
+    unittest.main()
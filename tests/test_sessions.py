@@ -0,0 +1,36 @@
+import sqlite3
+import time
+import unittest
+
+from support import AppTestCase, run_app
+
+
+class SessionPruneTest(AppTestCase):
+    """Clean-up of the sessions table."""
+
+    def issue(self):
+        conn = sqlite3.connect(run_app.DB_FILE)
+        try:
+            user_id = conn.execute("SELECT id FROM users WHERE username='test_user_1'").fetchone()[0]
+            token, _ = run_app.issue_session(conn, user_id, "test_user_1", None, None)
+            conn.commit()
+        finally:
+            conn.close()
+        return token, run_app.read_session_token(token)["sid"]
+
+    def test_prune_keeps_only_live_sessions(self):
+        live, live_sid = self.issue()
+        _, revoked_sid = self.issue()
+        _, expired_sid = self.issue()
+        run_app.revoke_session(revoked_sid)
+        self.execute("UPDATE sessions SET expires_at=? WHERE id=?", time.time() - 1, expired_sid)
+
+        self.assertEqual(run_app.prune_sessions(), 2)
+        self.assertEqual(self.execute("SELECT id FROM sessions"), [(live_sid,)])
+        # Still valid without the cache, straight from its row
+        run_app.session_cache.discard(live_sid)
+        self.assertEqual(run_app.validate_session(live)["username"], "test_user_1")
+
+
+if __name__ == "__main__":
+    unittest.main()
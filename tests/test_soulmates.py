@@ -0,0 +1,123 @@
+import unittest
+import uuid
+
+from support import AppTestCase, run_app
+from taste_match import TasteIndex
+
+# (user_id, title, progress) grouped by user. 红楼梦 is on every shelf, so it
+# says nothing about taste; ann and bob share two rarer books, ann and cat one.
+SHELVES = [
+    ("ann", "红楼梦", 10), ("ann", "《围城》", 100), ("ann", "活着", 50), ("ann", "边城", 0),
+    ("bob", "红楼梦", 0), ("bob", "围城", 80), ("bob", "活着 ", 100),
+    ("cat", "红楼梦", 30), ("cat", "边城", 20), ("cat", "呐喊", 0),
+    ("dan", "红楼梦", 0), ("dan", "呐喊", 100),
+]
+
+
+def brute_force_cosine(index, u, v):
+    def row(w):
+        return {index.cols[j]: index.vals[j] for j in range(index.ptr[w], index.ptr[w + 1])}
+    a, b = row(u), row(v)
+    dot = sum(w * b.get(book, 0.0) for book, w in a.items())
+    return dot / (index.norms[u] * index.norms[v])
+
+
+class TasteIndexTest(unittest.TestCase):
+    """The sparse user x book matrix and its neighbour ranking."""
+
+    def setUp(self):
+        self.index = TasteIndex(SHELVES)
+
+    def test_csr_rows_follow_the_shelves(self):
+        index = self.index
+        self.assertEqual(index.user_ids, ["ann", "bob", "cat", "dan"])
+        # 《围城》 and 围城, 活着 and "活着 " are one book each
+        self.assertEqual(index.titles, ["红楼梦", "《围城》", "活着", "边城", "呐喊"])
+        self.assertEqual(list(index.ptr), [0, 4, 7, 10, 12])
+        self.assertEqual(list(index.cols[index.ptr[1]:index.ptr[2]]), [0, 1, 2])
+
+    def test_csc_is_the_transpose_of_csr(self):
+        index = self.index
+        from_rows = sorted((index.cols[j], u, index.vals[j])
+                           for u in range(index.user_count) for j in range(index.ptr[u], index.ptr[u + 1]))
+        from_columns = sorted((b, index.reader_rows[j], index.reader_vals[j])
+                              for b in range(len(index.titles))
+                              for j in range(index.reader_ptr[b], index.reader_ptr[b + 1]))
+        self.assertEqual(from_rows, from_columns)
+        # Read by everyone: weight 0
+        self.assertTrue(all(index.reader_vals[j] == 0 for j in range(index.reader_ptr[0], index.reader_ptr[1])))
+
+    def test_neighbours_ranked_by_cosine(self):
+        index = self.index
+        matches = index.neighbours(0, 3)
+        self.assertEqual([user_id for user_id, _, _ in matches], ["bob", "cat"])
+        for user_id, score, _ in matches:
+            v = index.user_ids.index(user_id)
+            self.assertAlmostEqual(score, brute_force_cosine(index, 0, v), places=4)
+        # Shared books, heaviest first; the book everyone has isn't listed
+        self.assertEqual(matches[0][2], ["《围城》", "活着"])
+        self.assertEqual(index.neighbours(0, 1), matches[:1])
+
+    def test_popular_book_readers_are_capped_per_user(self):
+        rows = [(f"u{u}", "围城", 100) for u in range(6)] + [("u6", "活着", 100)]
+        index = TasteIndex(rows, max_book_readers=2)
+        for u in range(6):
+            # A rotating window of two readers: everyone still meets someone
+            matches = index.neighbours(u, 10)
+            self.assertTrue(1 <= len(matches) <= 2, (u, matches))
+
+    def test_empty_index(self):
+        index = TasteIndex([])
+        self.assertEqual(index.user_count, 0)
+        self.assertEqual(list(index.ptr), [0])
+
+    def test_one_user_has_no_neighbours(self):
+        index = TasteIndex([("ann", "围城", 100), ("ann", "活着", 0)])
+        self.assertEqual(index.user_count, 1)
+        self.assertEqual(index.neighbours(0, 5), [])
+
+    def test_books_without_a_title_are_skipped(self):
+        index = TasteIndex([("ann", "《》", 100), ("bob", "围城", 0)])
+        self.assertEqual(index.user_ids, ["bob"])
+
+
+class ComputeSoulmatesTest(AppTestCase):
+    """A full pass from the books table into the soulmates table."""
+
+    def add_user(self, username, titles):
+        user_id = str(uuid.uuid4())
+        self.execute("INSERT INTO users (id, username, password) VALUES (?, ?, 'x')", user_id, username)
+        for title in titles:
+            self.execute("INSERT INTO books (id, user_id, title, author, filepath) VALUES (?, ?, ?, 'Unknown', 'x.txt')",
+                         str(uuid.uuid4()), user_id, title)
+        return user_id
+
+    def test_pass_writes_matches_with_profiles(self):
+        ann = self.add_user("ann", ["围城", "活着", "边城"])
+        self.add_user("bob", ["围城", "活着"])
+        self.add_user("cat", ["边城"])
+        run_app.compute_soulmates()
+
+        matches = run_app.get_soulmates(ann)["soulmates"]
+        self.assertEqual([match["username"] for match in matches], ["bob", "cat"])
+        self.assertCountEqual(matches[0]["shared_books"], ["围城", "活着"])
+        self.assertEqual(matches[0]["avatar"], "default_avatar_1.svg")
+        self.assertTrue(0 < matches[1]["score"] < matches[0]["score"] <= 1)
+
+    def test_seeded_users_share_only_default_books(self):
+        # Every shelf holds the same default books: no signal, no matches
+        run_app.compute_soulmates()
+        rows = self.execute("SELECT matches FROM soulmates")
+        self.assertEqual(len(rows), 3)
+        self.assertTrue(all(row == ("[]",) for row in rows))
+
+    def test_rows_of_users_without_books_are_dropped(self):
+        run_app.compute_soulmates()
+        self.execute("DELETE FROM books")
+        run_app.compute_soulmates()
+        self.assertEqual(self.execute("SELECT COUNT(*) FROM soulmates"), [(0,)])
+        self.assertEqual(run_app.get_soulmates("nobody"), {"soulmates": [], "computed_at": None})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+import datetime
+import random
+import sqlite3
+import types
+import unittest
+import zoneinfo
+
+from support import AppTestCase, TempDirTestCase, run_app
+
+# 01:30 on 19 October in Beijing, still the 18th in UTC
+NOW = datetime.datetime(2026, 10, 18, 17, 30, tzinfo=datetime.timezone.utc)
+
+
+class FrozenDatetime(datetime.datetime):
+    @classmethod
+    def now(cls, tz=None):
+        return NOW.astimezone(tz) if tz else NOW.replace(tzinfo=None)
+
+
+class ReadingDayTest(AppTestCase):
+    """Reading days count in APP_TIMEZONE, not the server's clock."""
+
+    def setUp(self):
+        super().setUp()
+        self.patch(run_app, "datetime", types.SimpleNamespace(**{**vars(datetime), "datetime": FrozenDatetime}))
+        self.user_id, self.book_id = self.execute("SELECT user_id, id FROM books LIMIT 1")[0]
+
+    def test_progress_after_midnight_in_beijing_counts_for_the_new_day(self):
+        self.assertTrue(run_app.record_progress(self.user_id, self.book_id, 10, 3))
+        conn = sqlite3.connect(run_app.DB_FILE)
+        try:
+            self.assertEqual(conn.execute("SELECT day FROM reading_days").fetchall(), [("2026-10-19",)])
+            stats = run_app.get_user_stats(conn.cursor(), self.user_id)
+        finally:
+            conn.close()
+        self.assertEqual(stats["streak"], 1)
+        self.assertEqual(stats["reading_age_days"], 1)
+
+
+class UserStatsTriggerTest(AppTestCase):
+    """The trigger-maintained user_stats rows against a full recomputation."""
+
+    def test_rows_match_a_recount_after_mixed_writes(self):
+        rng = random.Random(7)
+        clock = {"now": NOW}
+
+        class SteppedDatetime(datetime.datetime):
+            @classmethod
+            def now(cls, tz=None):
+                return clock["now"].astimezone(tz) if tz else clock["now"].replace(tzinfo=None)
+
+        self.patch(run_app, "datetime", types.SimpleNamespace(**{**vars(datetime), "datetime": SteppedDatetime}))
+        users = [row[0] for row in self.execute("SELECT id FROM users")] + ["no-such-user"]
+        for step in range(300):
+            books = self.execute("SELECT id, user_id FROM books")
+            action = rng.choice(["insert", "progress", "update", "move", "delete"] if books else ["insert"])
+            if action == "insert":
+                self.execute("INSERT INTO books (id, user_id, title, filepath, progress, pages_read) VALUES (?, ?, ?, 'x.txt', ?, ?)",
+                             f"b{step}", rng.choice(users), f"书{step}", rng.choice([None, 0, 40, 100]),
+                             rng.choice([None, 0, 12]))
+            elif action == "progress":
+                book_id, user_id = rng.choice(books)
+                run_app.record_progress(user_id, book_id, rng.randint(0, 100), rng.randint(1, 50))
+            elif action == "update":
+                self.execute("UPDATE books SET progress=?, pages_read=? WHERE id=?",
+                             rng.choice([None, 0, 1, 99, 100]), rng.choice([None, 5]), rng.choice(books)[0])
+            elif action == "move":
+                self.execute("UPDATE books SET user_id=? WHERE id=?", rng.choice(users + [None]), rng.choice(books)[0])
+            else:
+                self.execute("DELETE FROM books WHERE id=?", rng.choice(books)[0])
+            # Sometimes the next day, sometimes a skipped one
+            if rng.random() < 0.1:
+                clock["now"] += datetime.timedelta(days=rng.choice([1, 1, 2]))
+
+        self.assertGreater(self.execute("SELECT COUNT(*) FROM reading_days")[0][0], 5)
+        conn = sqlite3.connect(run_app.DB_FILE)
+        try:
+            self.assertEqual(run_app.check_user_stats(conn.cursor()), [])
+        finally:
+            conn.close()
+
+
+def no_tz_database(name):
+    raise zoneinfo.ZoneInfoNotFoundError(name)
+
+
+class AppTimezoneTest(TempDirTestCase):
+    """The fallback when APP_TIMEZONE can't be loaded."""
+
+    def test_unknown_zone_falls_back_to_utc(self):
+        self.assertEqual(run_app.load_app_timezone("Europe/Nowhere"), datetime.timezone.utc)
+
+    def test_shanghai_without_tz_database_is_fixed_utc_plus_8(self):
+        self.patch(zoneinfo, "ZoneInfo", no_tz_database)
+        tz = run_app.load_app_timezone("Asia/Shanghai")
+        self.assertEqual(tz.utcoffset(None), datetime.timedelta(hours=8))
+        self.assertEqual(run_app.load_app_timezone("Asia/Tokyo"), datetime.timezone.utc)
+
+
+if __name__ == "__main__":
+    unittest.main()
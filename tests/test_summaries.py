@@ -0,0 +1,82 @@
+import os
+import sqlite3
+import threading
+import unittest
+
+from support import AppTestCase, run_app
+from fake_upstream import start_fake_upstream
+
+# Chapters need a few hundred characters of body to count as chapters
+BOOK = "".join(f"{title}\n{line * 40}\n\n" for title, line in
+               [("第一章 出门", "他出了门。"), ("第二章 下雨", "天下起了雨。"), ("第三章 回家", "他又回了家。")])
+
+
+class SummaryTest(AppTestCase):
+    """Book summaries end to end against the fake upstream, offline."""
+
+    def setUp(self):
+        super().setUp()
+        self.upstream, url = start_fake_upstream()
+        self.addCleanup(self.upstream.server_close)
+        self.addCleanup(self.upstream.shutdown)
+        self.patch(run_app, "DASHSCOPE_API_URL", url)
+        self.patch(run_app, "DASHSCOPE_API_KEY", "test-key")
+        with open(os.path.join(run_app.BOOKS_DIR, "walk.txt"), 'w', encoding='utf-8') as f:
+            f.write(BOOK)
+
+    def work_queue(self):
+        while (job := run_app.claim_job("test")) is not None:
+            run_app.run_job(job, "test")
+
+    def test_summarizes_each_chapter_then_the_book(self):
+        run_app.summarize_book("walk.txt")
+        chapters = self.execute("SELECT title, summary FROM chapter_summaries ORDER BY chapter_index")
+        self.assertEqual([title for title, _ in chapters], ["第一章 出门", "第二章 下雨", "第三章 回家"])
+        self.assertTrue(all(summary.startswith("概要：") for _, summary in chapters))
+        self.assertEqual(len(self.execute("SELECT 1 FROM book_summaries")), 1)
+        self.assertEqual(self.upstream.stats["calls"], 4)
+
+        # Done blobs cost nothing on the next pass
+        run_app.summarize_book("walk.txt")
+        self.assertEqual(self.upstream.stats["calls"], 4)
+
+    def test_queue_pass_queues_each_missing_blob_once(self):
+        self.assertEqual(run_app.queue_book_summaries(), 1)
+        self.assertEqual(run_app.queue_book_summaries(), 1)
+        self.assertEqual(self.execute("SELECT COUNT(*) FROM jobs WHERE kind='summarize_book'"), [(1,)])
+
+        self.work_queue()
+        self.assertEqual(self.execute("SELECT status FROM jobs"), [("done",)])
+        self.assertEqual(run_app.queue_book_summaries(), 0)
+        self.assertEqual(self.upstream.stats["calls"], 4)
+
+    def test_nothing_is_queued_or_called_without_an_api_key(self):
+        run_app.queue_book_summaries()
+        self.patch(run_app, "DASHSCOPE_API_KEY", "")
+        self.assertEqual(run_app.queue_book_summaries(), 0)
+
+        # A job queued while the key was set finishes without calling upstream
+        self.work_queue()
+        self.assertEqual(self.execute("SELECT status, result FROM jobs"),
+                         [("done", '{"skipped": "DASHSCOPE_API_KEY is not set"}')])
+        self.assertEqual(self.upstream.stats["calls"], 0)
+        self.assertEqual(self.execute("SELECT COUNT(*) FROM jobs"), [(1,)])
+
+    def test_summary_loop_survives_database_errors(self):
+        stop_event = threading.Event()
+        calls = []
+
+        def failing_pass(stop_event):
+            calls.append(1)
+            if len(calls) > 1:
+                stop_event.set()
+            raise sqlite3.OperationalError("database is locked")
+
+        self.patch(run_app, "queue_book_summaries", failing_pass)
+        self.patch(run_app, "SUMMARY_INTERVAL", 0)
+        run_app.run_summary_loop(stop_event)
+        self.assertEqual(len(calls), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
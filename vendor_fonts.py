@@ -0,0 +1,89 @@
+import hashlib
+import os
+import re
+import urllib.request
+
+# Downloads the web fonts the pages use into static/fonts/, writes
+# static/fonts/fonts.css pointing at the local copies, and switches the
+# pages' font CDN links (and their preconnect hints) over to it, so no page
+# depends on a font CDN. Files are named by content hash, so a font updated
+# upstream gets a new URL and the service worker never serves a stale copy.
+# The CJK fonts come in unicode-range slices (a few hundred files), of which
+# a browser only loads the ones a page needs.
+# Usage: python vendor_fonts.py
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+FONTS_DIR = os.path.join(BASE_DIR, "static", "fonts")
+FONTS_CSS = os.path.join(FONTS_DIR, "fonts.css")
+FONT_CSS_URLS = [
+    "https://fonts.loli.net/css2?family=Noto+Serif+SC:wght@400;500;600;700&family=Noto+Sans+SC:wght@300;400;500&family=Inter:wght@400;500;600&family=Zhi+Mang+Xing&display=swap",
+    "https://fonts.googleapis.com/css2?family=Material+Symbols+Outlined:wght,FILL@100..700,0..1&display=swap",
+]
+# The font CSS API only serves woff2 to browsers it recognizes
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36"
+FONT_URL_RE = re.compile(r'url\((https://[^)]+)\)')
+PAGES = ["bookshelf.html", "chat.html", "login.html", "notes.html", "profile.html", "reader.html"]
+# A run of font stylesheet links becomes one link to fonts.css
+FONT_LINKS_RE = re.compile(r'(?:([ \t]*)<link\s[^>]*href="https://fonts\.[^"]*/css2[^"]*"[^>]*>\n)+')
+PRECONNECT_RE = re.compile(r'[ \t]*(?:<!-- Preconnect for faster font loading -->|<link rel="preconnect" href="https://fonts\.[^"]*"[^>]*>)\n')
+
+HEADER = """/* Web fonts for every page, in one stylesheet the service worker precaches.
+   Generated by vendor_fonts.py from:
+{sources}
+*/
+"""
+
+def local_font_link(match):
+    # Pages that load fonts without blocking render keep doing so
+    deferred = ' media="print" onload="this.media=\'all\'"' if 'media="print"' in match.group(0) else ''
+    return f'{match.group(1)}<link href="/static/fonts/fonts.css" rel="stylesheet"{deferred} />\n'
+
+def rewrite_page(path):
+    with open(path, encoding='utf-8') as f:
+        html = f.read()
+    rewritten = FONT_LINKS_RE.sub(local_font_link, PRECONNECT_RE.sub('', html))
+    if rewritten != html:
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(rewritten)
+    return rewritten != html
+
+def fetch(url):
+    req = urllib.request.Request(url, headers={"User-Agent": USER_AGENT})
+    with urllib.request.urlopen(req, timeout=60) as res:
+        return res.read()
+
+def vendor_font(url):
+    data = fetch(url)
+    ext = os.path.splitext(url.split('?')[0])[1] or ".woff2"
+    name = hashlib.sha256(data).hexdigest()[:16] + ext
+    path = os.path.join(FONTS_DIR, name)
+    if not os.path.exists(path):
+        with open(path, 'wb') as f:
+            f.write(data)
+    return f"/static/fonts/{name}"
+
+if __name__ == "__main__":
+    os.makedirs(FONTS_DIR, exist_ok=True)
+    parts = []
+    local = {}
+    for css_url in FONT_CSS_URLS:
+        css = fetch(css_url).decode('utf-8')
+        for font_url in sorted(set(FONT_URL_RE.findall(css))):
+            local[font_url] = vendor_font(font_url)
+        parts.append(FONT_URL_RE.sub(lambda m: f"url({local[m.group(1)]})", css))
+        print(f"{css_url}: {len(FONT_URL_RE.findall(css))} font files")
+
+    sources = "\n".join(f"   {url}" for url in FONT_CSS_URLS)
+    with open(FONTS_CSS, 'w', encoding='utf-8') as f:
+        f.write(HEADER.format(sources=sources) + "\n".join(parts))
+
+    # Slices no longer referenced by fonts.css
+    keep = {os.path.basename(path) for path in local.values()} | {"fonts.css"}
+    stale = [name for name in os.listdir(FONTS_DIR) if name not in keep]
+    for name in stale:
+        os.remove(os.path.join(FONTS_DIR, name))
+    print(f"Wrote {FONTS_CSS} ({len(local)} font files, {len(stale)} stale removed)")
+
+    for page in PAGES:
+        if rewrite_page(os.path.join(BASE_DIR, page)):
+            print(f"{page}: font links now point at /static/fonts/fonts.css")